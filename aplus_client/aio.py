@@ -0,0 +1,594 @@
+"""
+asyncio variant of the A-Plus API client.
+
+The API mirrors aplus_client.client, but everything doing I/O is awaitable:
+
+    async with AsyncAplusTokenClient(token, version=2) as client:
+        course = await client.load_data(url)
+        async for student in await course.get('students'):
+            print(await student['full_name'])
+"""
+import asyncio
+import logging
+from collections import deque
+from functools import partial
+from os import replace
+from os.path import isfile
+from time import perf_counter
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .client import (
+    AplusApiDict,
+    AplusApiError,
+    AplusApiList,
+    AplusApiLoadError,
+    AplusApiObject,
+    AplusApiPaginated,
+    AplusClient,
+    AplusGraderClient,
+    AplusTokenClient,
+    ConnectionErrorResponse,
+    NoDefault,
+)
+from .debugging import AsyncAplusClientDebugging, FakeResponse
+
+
+logger = logging.getLogger('aplus_client.client')
+
+
+class AsyncResponse(FakeResponse):
+    """
+    Fully read response returned by the async transports
+    """
+    def __init__(self, url, status_code, content, headers=None, encoding='utf-8'):
+        super().__init__(url, status_code, content.decode(encoding, 'replace'), headers)
+        self.content = content
+
+
+class AsyncTransport:
+    """
+    Base class for the HTTP layer of AsyncAplusClient
+
+    request() returns a response with status_code, headers, content, json()
+    and raise_for_status(). Connection errors and timeouts are returned as
+    ConnectionErrorResponse.
+    """
+    async def request(self, method, url, headers=None, params=None, data=None, json=None, timeout=None):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class ThreadedTransport(AsyncTransport):
+    """
+    Runs blocking requests calls in an executor. Needs no extra dependencies,
+    but the concurrency is bounded by the executor.
+    """
+    def __init__(self, session=None, executor=None):
+        self.session = requests.session() if session is None else session
+        self.executor = executor
+
+    async def request(self, method, url, **kwargs):
+        loop = asyncio.get_running_loop()
+        func = partial(self.session.request, method, url, **kwargs)
+        try:
+            return await loop.run_in_executor(self.executor, func)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as err:
+            return ConnectionErrorResponse(err, url)
+
+
+class AiohttpTransport(AsyncTransport):
+    """
+    Transport using aiohttp, which runs all requests on the event loop thread.
+    The limit is the maximum number of simultaneous connections.
+    """
+    def __init__(self, session=None, limit=100):
+        if aiohttp is None:
+            raise ImportError("AiohttpTransport requires aiohttp")
+        self._session = session
+        self.limit = limit
+
+    @property
+    def session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    @staticmethod
+    def _timeout(timeout):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        return aiohttp.ClientTimeout(total=timeout)
+
+    async def request(self, method, url, headers=None, params=None, data=None, json=None, timeout=None):
+        try:
+            async with self.session.request(method, url,
+                    headers=headers, params=params, data=data, json=json,
+                    timeout=self._timeout(timeout)) as resp:
+                content = await resp.read()
+                return AsyncResponse(str(resp.url), resp.status, content,
+                                     headers=resp.headers,
+                                     encoding=resp.charset or 'utf-8')
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+            return ConnectionErrorResponse(err, url)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncSingleFlight:
+    """
+    asyncio variant of aplus_client.util.SingleFlight
+
+    The function runs in its own task, so a caller that is cancelled stops
+    waiting for it without cancelling it for the others.
+    """
+    def __init__(self):
+        self._tasks = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, func, *args, **kwargs):
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(func(*args, **kwargs))
+            task.add_done_callback(partial(self._done, key))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # the callers get the error, so it doesn't need to be logged as unretrieved
+            task.exception()
+
+
+class AsyncAplusApiObject(AplusApiObject):
+    """
+    Base class for async A-Plus API objects
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def _wrap(client, data, source_url=None):
+        if isinstance(data, dict):
+            if AplusApiPaginated.is_paginated(data, source_url):
+                cls = AsyncAplusApiPaginated
+            elif AplusApiError.is_error(data):
+                cls = AplusApiError
+            else:
+                cls = AsyncAplusApiDict
+        elif isinstance(data, list):
+            cls = AsyncAplusApiList
+        else:
+            return data
+
+        identity_map = getattr(client, 'identity_map', None)
+        if identity_map is not None and issubclass(cls, AplusApiDict):
+            return identity_map.wrap(cls, client, data, source_url)
+        return cls(client=client, data=data, source_url=source_url)
+
+
+class AsyncAplusApiDict(AsyncAplusApiObject, AplusApiDict):
+    """
+    Represents dict types returned from A-Plus API.
+    Reading values may load more data, thus get(), obj[key] and obj.key
+    return awaitables.
+    """
+    __slots__ = ()
+
+    async def load_all(self):
+        furl = self._full_url
+        if furl and self._source_url != furl:
+            self._traversed('load_all', furl)
+            data = await self._client._load_cached_data(furl)
+            if data:
+                self._add_complete_data(data, furl)
+                return True
+        return False
+
+    async def get_item(self, key, default=NoDefault):
+        try:
+            return self._data[key]
+        except KeyError as err:
+            if await self.load_all():
+                try:
+                    return self._data[key]
+                except KeyError:
+                    pass
+
+            if default is not NoDefault:
+                return default
+            raise err
+
+    async def get(self, key, default=None):
+        value = await self.get_item(key, default=default)
+        if self._is_api_url(key, value):
+            self._traversed('link', value)
+            try:
+                return await self._client.load_data(value)
+            except Exception:
+                logger.exception("couldn't get json for %s", value)
+        return self._wrap(self._client, value)
+
+    def __contains__(self, key):
+        # can't load more data here, so only the loaded keys are checked
+        return key in self._data
+
+    def __getattr__(self, key):
+        # a fully loaded object can't get more keys, so missing ones fail here
+        if key.startswith('_') or (key not in self._data and (self.is_all_loaded or not self._full_url)):
+            raise AttributeError("%s has no attribute '%s'" % (self, key))
+        return self[key]
+
+
+class AsyncAplusApiList(AsyncAplusApiObject, AplusApiList):
+    """
+    Represents list types returned from A-Plus API
+    """
+    __slots__ = ()
+
+    async def __aiter__(self):
+        for value in self._iter_from(0):
+            yield value
+
+
+class AsyncAplusApiPaginated(AsyncAplusApiList, AplusApiPaginated):
+    """
+    Represents paginated responses from A-Plus API.
+    Use `async for` to iterate over all results and `await items[i]` or
+    `await items[i:j]` for random access.
+    """
+    __slots__ = ()
+
+    def __iter__(self):
+        raise TypeError("%s requires 'async for'" % (self.__class__.__name__,))
+
+    def __getitem__(self, idx):
+        return self._getitem(idx)
+
+    async def _getitem(self, idx):
+        if isinstance(idx, slice):
+            indices = range(*idx.indices(self._count))
+            await self._load_pages(self._pages_needed(indices))
+            return [await self._item_at(i) for i in indices]
+        return await self._item_at(self._check_index(idx))
+
+    async def _item_at(self, idx):
+        while idx >= len(self._data) and self._page_url(0) is None:
+            url = self._next
+            if not await self.load_next():
+                if url:
+                    raise self._page_error(url)
+                break
+        if idx < len(self._data):
+            return self._item(idx)
+        if self._page_url(0) is None:
+            raise IndexError("%s index out of range" % (self.__class__.__name__,))
+        page, at = divmod(idx, self._page_size)
+        url = self._page_url(page)
+        data = self._pages.get(page)
+        if data is None:
+            data = await self._client._load_cached_data(url)
+            if data is None:
+                raise self._page_error(url)
+            self._add_page(page, data)
+            if idx < len(self._data):
+                return self._item(idx)
+            data = self._pages.get(page)
+        return self._page_item(data, at, url)
+
+    async def _load_pages(self, pages):
+        if len(pages) > 1:
+            urls = [self._page_url(page) for page in pages]
+            concurrency = self._client.prefetch_workers or 1
+            page_iter = iter(pages)
+            async for data in self._prefetch_pages(urls, concurrency):
+                self._add_page(next(page_iter), data)
+
+    async def __aiter__(self):
+        for value in self._iter_from(0):
+            yield value
+        workers = self._client.prefetch_workers
+        urls = self._remaining_page_urls() if workers and self._next else None
+        if urls:
+            async for data in self._prefetch_pages(urls, workers):
+                if data is None:
+                    break
+                at = len(self._data)
+                self.add_data(data)
+                for value in self._iter_from(at):
+                    yield value
+        while True:
+            at = len(self._data)
+            if not await self.load_next():
+                break
+            for value in self._iter_from(at):
+                yield value
+
+    async def _prefetch_pages(self, urls, concurrency):
+        """
+        Loads pages concurrently and yields their data in order.
+        At most `concurrency` pages are requested at once.
+        """
+        load = self._client._load_cached_data
+        pending = deque()
+        try:
+            for url in urls:
+                pending.append(asyncio.ensure_future(load(url)))
+                if len(pending) >= concurrency:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def load_next(self):
+        if self._next:
+            data = self._stored_next_page()
+            if data is None:
+                data = await self._client._load_cached_data(self._next)
+            if data is None:
+                return False
+            self.add_data(data)
+            return True
+        return False
+
+
+class AsyncAplusClient(AplusClient):
+    """
+    asyncio variant of AplusClient.
+
+    Requests are made through the transport, which defaults to aiohttp when
+    it's installed and to a thread pool otherwise. If prefetch_workers is
+    set, it limits how many pages of paginated responses are loaded at once.
+    Caches doing blocking I/O (FilesystemCache, SQLiteCache) are used in
+    threads.
+    """
+    debugging_mixin = AsyncAplusClientDebugging
+    api_object_class = AsyncAplusApiObject
+
+    def __init__(self, *args, transport=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if transport is None:
+            transport = AiohttpTransport() if aiohttp else ThreadedTransport(self.session)
+        self.transport = transport
+        self.single_flight = AsyncSingleFlight()
+        self._revalidation_tasks = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.transport.close()
+
+    async def do_get(self, url, **kwargs):
+        url = self._get_full_url(url)
+        headers = self.get_headers()
+        headers.update(kwargs.pop('headers', None) or {})
+        kwargs['headers'] = headers
+        kwargs['params'] = self.get_params_for(url)
+        kwargs.setdefault('timeout', (3.2, 9.6))
+        logger.debug("making GET '%s', %s", url, kwargs)
+        return await self._send('GET', url, **kwargs)
+
+    async def do_post(self, url, data=None, json=None, timeout=None):
+        assert data or json, 'You must specify either data or json'
+        url = self._get_full_url(url)
+        headers = self.get_headers()
+        params = self.get_params()
+        if not timeout:
+            timeout = (3.2, 9.6)
+        logger.debug("making POST '%s', headers=%r, params=%r, data=%r, json=%r", url, headers, params, data, json)
+        return await self._send('POST', url,
+            headers=headers, params=params, data=data, json=json, timeout=timeout)
+
+    async def _send(self, method, url, **kwargs):
+        send = partial(self.transport.request, method, url, **kwargs)
+        if self.rate_limiter is not None:
+            send = partial(self.rate_limiter.call_async, url, send)
+        started = perf_counter()
+        try:
+            if self.policy is None:
+                resp = await send()
+            else:
+                resp = await self.policy.call_async(method, url, send)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as err:
+            resp = ConnectionErrorResponse(err, url)
+        self._instrument_request(method, url, resp, perf_counter() - started)
+        return resp
+
+    async def _load_json_data(self, url, entry=None):
+        headers = entry.conditional_headers() if entry is not None else None
+        resp = await self.do_get(url, headers=headers)
+        return self._parse_json_response(url, resp, entry), resp
+
+    async def _cache_io(self, func, url, *args):
+        """
+        Calls func(url, *args), a cache method of the client, in a thread
+        if the cache of url does blocking I/O (blocking_io)
+        """
+        if getattr(self._cache_target(url)[0], 'blocking_io', False):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, partial(func, url, *args))
+        return func(url, *args)
+
+    async def _load_cached_data(self, url, skip_cache=False):
+        try:
+            if skip_cache:
+                raise KeyError
+            data = await self._cache_io(self._cache_get, url)
+        except KeyError:
+            entry = None if skip_cache else await self._cache_io(self._cache_get_entry, url)
+            if entry is not None and self._can_serve_stale(entry):
+                logger.debug("stale cache hit for %r", url)
+                self._instrument_stale(url)
+                self._revalidate_in_background(url, entry)
+                return entry.data
+            load = self._load_and_cache if skip_cache else self._load_missing
+            data = await self.single_flight.do(self._request_key(url), load, url, entry)
+        else:
+            logger.debug("cache hit for %r", url)
+        return data
+
+    async def _load_missing(self, url, entry=None):
+        data = await self._cache_io(self._cache_peek, url)
+        if data is not None:
+            return data
+        return await self._load_and_cache(url, entry)
+
+    async def _load_and_cache(self, url, entry=None):
+        try:
+            data, resp = await self._load_json_data(url, entry)
+        except ValueError:
+            return None
+        await self._cache_io(self._cache_set, url, data, *self._response_validators(resp, entry))
+        return data
+
+    def _revalidate_in_background(self, url, entry):
+        key = self._request_key(url)
+        if key not in self._revalidating:
+            self._revalidating.add(key)
+            # the set keeps a reference to the task until it's done
+            task = asyncio.ensure_future(self._revalidate(key, url, entry))
+            self._revalidation_tasks.add(task)
+            task.add_done_callback(self._revalidation_tasks.discard)
+
+    async def _revalidate(self, key, url, entry):
+        try:
+            await self.single_flight.do(key, self._load_missing, url, entry)
+        except Exception:
+            logger.exception("revalidation of %r failed", url)
+        finally:
+            self._revalidating.discard(key)
+
+    async def load_data(self, url, skip_cache=False):
+        url = self._get_full_url(url)
+        data = await self._load_cached_data(url, skip_cache=skip_cache)
+        return self.api_object_class._wrap(client=self, data=data, source_url=url)
+
+    async def load_many(self, urls, concurrency=8, skip_cache=False):
+        """
+        asyncio variant of AplusClient.load_many. At most `concurrency`
+        requests are made at once.
+        """
+        full_urls = [self._get_full_url(url) for url in urls]
+        results = {}
+        missing = []
+        for url in dict.fromkeys(full_urls):
+            try:
+                if skip_cache:
+                    raise KeyError
+                results[url] = await self._cache_io(self._cache_get, url)
+            except KeyError:
+                missing.append(url)
+        if missing:
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def load(url):
+                async with semaphore:
+                    return await self._load_data_or_error(url, skip_cache=skip_cache)
+
+            results.update(zip(missing, await asyncio.gather(*map(load, missing))))
+        return self._wrap_many(full_urls, results)
+
+    async def prefetch(self, items, *paths, concurrency=8):
+        """
+        asyncio variant of AplusClient.prefetch. items may be an async
+        iterable, e.g. a paginated listing.
+        """
+        if hasattr(items, '__aiter__'):
+            items = [item async for item in items]
+        steps = self._prefetch_steps(items, paths)
+        try:
+            urls = next(steps)
+            while True:
+                urls = steps.send(await self.load_many(urls, concurrency=concurrency))
+        except StopIteration as stop:
+            return stop.value
+
+    async def _load_data_or_error(self, url, skip_cache=False):
+        try:
+            data = await self._load_cached_data(url, skip_cache=skip_cache)
+        except Exception as err:
+            status_code = getattr(getattr(err, 'response', None), 'status_code', None)
+            return AplusApiLoadError(self, url, status_code, err)
+        if data is None:
+            return AplusApiLoadError(self, url)
+        return data
+
+    async def load_file(self, filename, url, revalidate=False, force=False):
+        exists = isfile(filename)
+        if exists and not (revalidate or force):
+            return filename
+        url = self._get_full_url(url)
+        headers = None
+        if exists and not force:
+            headers = self._file_conditional_headers(filename)
+        resp = await self.do_get(url, headers=headers)
+        if resp.status_code == 304:
+            return filename
+        if resp.status_code != 200:
+            return None
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(resp.content)
+        replace(tmp_filename, filename)
+        self._set_file_mtime(filename, resp)
+        return self._attachment_filename(resp, filename)
+
+
+class AsyncAplusTokenClient(AsyncAplusClient, AplusTokenClient):
+    """
+    asyncio variant of AplusTokenClient
+    """
+
+
+class AsyncAplusGraderClient(AsyncAplusClient, AplusGraderClient):
+    """
+    asyncio variant of AplusGraderClient.
+    `await client.grading_data` loads the grading data once.
+    """
+    @property
+    def grading_data(self):
+        return self.load_grading_data()
+
+    def prefetch_grading_data(self):
+        """
+        Starts loading grading_data in a task
+        """
+        if self._grading_data is None:
+            self._grading_data = asyncio.ensure_future(self.load_data(self.grading_url))
+        return self._grading_data
+
+    async def load_grading_data(self):
+        data = self._grading_data
+        if data is None:
+            data = self._grading_data = await self.load_data(self.grading_url)
+        elif isinstance(data, asyncio.Future):
+            data = self._grading_data = await data
+        return data
+
+    async def grade(self, data, **kwargs):
+        resp = self._enqueue_grade(data, **kwargs)
+        if resp is None:
+            resp = await self.do_post(self.grading_url, data, **kwargs)
+        return resp
@@ -1,59 +1,289 @@
+import sqlite3
 from cachetools import TTLCache
-from urllib.parse import quote_plus as quote, unquote_plus as unquote
-from os import makedirs
-from os.path import join, exists, getmtime
-from json import dump as json_dump, load as json_load
+from collections.abc import MutableMapping
+from hashlib import sha1
+from os import getpid, makedirs, remove, replace, scandir, stat, utime
+from os.path import dirname, getsize, join
+from tempfile import mkstemp
+from threading import RLock, local
 from time import time
 
+from .serializers import SerializationError, get_serializer
+
+
+class CacheEntry:
+    """
+    Cached data together with the validators of the response it came from
+    """
+    __slots__ = ('data', 'etag', 'last_modified', 'expires')
+
+    def __init__(self, data, etag=None, last_modified=None, expires=0):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = expires
+
+    def is_fresh(self, now=None):
+        return (time() if now is None else now) < self.expires
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+def _notify_evicted(cache, count):
+    if count and cache.on_evict is not None:
+        cache.on_evict(cache, count)
+
 
 class InMemoryCache(TTLCache):
+    """
+    Expired entries are kept for keep_stale seconds (default: ttl), so they
+    can be revalidated with a conditional request. During the first
+    stale_while_revalidate seconds after expiry, the client returns the
+    expired data and refreshes it in the background.
+
+    All caches call on_evict(cache, count), if set, when entries are
+    evicted or expire (see aplus_client.instrumentation).
+    """
+    on_evict = None
+    _evicting = False
+    _clearing = False
+
     def __init__(self, **kwargs):
         kwargs.setdefault('maxsize', 100)
         kwargs.setdefault('ttl', 60)
+        self.keep_stale = kwargs.pop('keep_stale', kwargs['ttl'])
+        self.stale_while_revalidate = kwargs.pop('stale_while_revalidate', 0)
         super().__init__(**kwargs)
+        self._entries = TTLCache(
+            maxsize=kwargs['maxsize'],
+            ttl=kwargs['ttl'] + max(self.keep_stale, self.stale_while_revalidate),
+        )
+
+    def __setitem__(self, url, data):
+        self.set_entry(url, data)
+
+    def get_entry(self, url):
+        return self._entries.get(url)
+
+    def set_entry(self, url, data, etag=None, last_modified=None):
+        super().__setitem__(url, data)
+        self._entries[url] = CacheEntry(data, etag, last_modified, time() + self.ttl)
+
+    def __delitem__(self, url):
+        if not self._evicting:
+            self._entries.pop(url, None)
+        super().__delitem__(url)
+
+    def clear(self):
+        # removed through popitem(), but they aren't evictions
+        self._clearing = True
+        try:
+            super().clear()
+        finally:
+            self._clearing = False
+        self._entries.clear()
+
+    def popitem(self):
+        # entries evicted for space are kept for revalidation
+        self._evicting = True
+        try:
+            item = super().popitem()
+        finally:
+            self._evicting = False
+        if not self._clearing:
+            _notify_evicted(self, 1)
+        return item
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        _notify_evicted(self, len(expired))
+        return expired
 
 
 class FilesystemCache(TTLCache):
-    _ext = '.json'
+    """
+    In-memory cache backed by files in cache_dir.
+
+    Files are stored in shard directories named by the url hash and are
+    written atomically. The file mtime is the store time and the atime is
+    the last read from disk. When max_bytes is set, the least recently used
+    files are removed once the total size grows over it. Hits served from
+    memory count as uses too.
+
+    Expired files are kept for revalidation until prune() removes the ones
+    expired more than keep_stale seconds ago (default: ttl). Iteration and len() cover all
+    files on disk, including expired ones. See InMemoryCache for
+    stale_while_revalidate.
+
+    Files are written with serializer (see aplus_client.serializers,
+    default: json). Files written in another format are removed on read.
+
+    Reads and writes block, so AsyncAplusClient runs them in threads
+    (blocking_io).
+    """
+    _ext = '.cache'
+    _evict_to = 0.9
+    on_evict = None
+    blocking_io = True
 
     def __init__(self, cache_dir, **kwargs):
         kwargs.setdefault('maxsize', 100)
         kwargs.setdefault('ttl', 3600)
+        self.keep_stale = kwargs.pop('keep_stale', kwargs['ttl'])
+        self.stale_while_revalidate = kwargs.pop('stale_while_revalidate', 0)
+        self.max_bytes = kwargs.pop('max_bytes', None)
+        self.serializer = get_serializer(kwargs.pop('serializer', None))
         super().__init__(**kwargs)
 
         self.cache_dir = cache_dir
-        if not exists(cache_dir):
-            makedirs(cache_dir)
+        makedirs(cache_dir, exist_ok=True)
+        self._lock = RLock()
+        self._size = None
+        # file name -> time of the last hit served from memory, for the LRU
+        self._accessed = {}
 
     def _fn(self, url):
-        fn = quote(url) + self._ext
-        return join(self.cache_dir, fn)
+        digest = sha1(url.encode('utf-8')).hexdigest()
+        return join(self.cache_dir, digest[:2], digest[2:4], digest + self._ext)
 
-    def _exists(self, fn):
-        return (
-            exists(fn) and
-            time() < getmtime(fn) + self.ttl
-        )
+    def _files(self):
+        """
+        Yields os.DirEntry for all cache files
+        """
+        for shard in _scandir_dirs(self.cache_dir):
+            for subshard in _scandir_dirs(shard.path):
+                for entry in scandir(subshard.path):
+                    if entry.name.endswith(self._ext) and entry.is_file():
+                        yield entry
+
+    def _stat(self, fn):
+        try:
+            return stat(fn)
+        except FileNotFoundError:
+            return None
+
+    def _load(self, fn):
+        try:
+            with open(fn, 'rb') as f:
+                return self.serializer.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except SerializationError:
+            self._remove(fn)
+            return None
+
+    def _read(self, fn):
+        record = self._load(fn)
+        if record is None:
+            return None
+        try:
+            # update atime for the LRU eviction
+            utime(fn, (time(), stat(fn).st_mtime))
+        except OSError:
+            pass
+        return record
+
+    def _write(self, fn, record):
+        shard = dirname(fn)
+        makedirs(shard, exist_ok=True)
+        fd, tmp_fn = mkstemp(dir=shard, suffix='.tmp')
+        try:
+            with open(fd, 'wb') as f:
+                f.write(self.serializer.dumps(record))
+            old = self._stat(fn)
+            replace(tmp_fn, fn)
+        except BaseException:
+            self._remove(tmp_fn)
+            raise
+        if self.max_bytes:
+            with self._lock:
+                if self._size is None:
+                    self._size = sum(entry.stat().st_size for entry in self._files())
+                else:
+                    self._size += getsize(fn) - (old.st_size if old else 0)
+                if self._size > self.max_bytes:
+                    self._evict()
+
+    def _remove(self, fn):
+        try:
+            remove(fn)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        accessed = self._accessed
+        files = [(entry.stat(), entry.path) for entry in self._files()]
+        files.sort(key=lambda f: max(f[0].st_atime, accessed.get(f[1], 0)))
+        size = sum(st.st_size for st, fn in files)
+        limit = self.max_bytes * self._evict_to
+        evicted = 0
+        for st, fn in files:
+            if size <= limit:
+                break
+            self._remove(fn)
+            accessed.pop(fn, None)
+            size -= st.st_size
+            evicted += 1
+        self._size = size
+        _notify_evicted(self, evicted)
+
+    def _is_fresh(self, st):
+        return st is not None and time() < st.st_mtime + self.ttl
+
+    def __getitem__(self, url):
+        data = super().__getitem__(url)
+        if self.max_bytes:
+            self._accessed[self._fn(url)] = time()
+        return data
 
     def __missing__(self, url):
-        self._found = False
         fn = self._fn(url)
-        if self._exists(fn):
-            with open(self._fn(url)) as f:
-                data = json_load(f)
-            super().__setitem__(url, data)
-            return data
+        if self._is_fresh(self._stat(fn)):
+            record = self._read(fn)
+            if record is not None:
+                data = record['data']
+                super().__setitem__(url, data)
+                return data
         raise KeyError(url)
 
     def __contains__(self, url):
         if super().__contains__(url):
             return True
-        return self._exists(self._fn(url))
+        return self._is_fresh(self._stat(self._fn(url)))
+
+    def get(self, url, default=None):
+        # __contains__ only checks the file exists, so it can't be used here
+        try:
+            return self[url]
+        except KeyError:
+            return default
 
     def __setitem__(self, url, data):
+        self.set_entry(url, data)
+
+    def get_entry(self, url):
+        fn = self._fn(url)
+        st = self._stat(fn)
+        record = self._read(fn) if st else None
+        if record is None:
+            return None
+        return CacheEntry(record['data'], record.get('etag'), record.get('last_modified'),
+                          st.st_mtime + self.ttl)
+
+    def set_entry(self, url, data, etag=None, last_modified=None):
         super().__setitem__(url, data)
-        with open(self._fn(url), 'w') as f:
-            json_dump(data, f)
+        self._write(self._fn(url), {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'data': data,
+        })
 
     # TTLCache uses `del self[key]` and we do not wan't to remove file on maxsize
     #def __delitem__(self, url):
@@ -61,10 +291,174 @@ class FilesystemCache(TTLCache):
     #    raise NotImplementedError
 
     def __iter__(self):
-        raise NotImplementedError
+        for entry in self._files():
+            record = self._load(entry.path)
+            if record is not None:
+                yield record['url']
+
+    def __len__(self):
+        return sum(1 for entry in self._files())
+
+    def clear(self):
+        with self._lock:
+            for entry in self._files():
+                self._remove(entry.path)
+            self._size = 0 if self.max_bytes else None
+            self._accessed.clear()
+        super().clear()
+
+    def prune(self):
+        """
+        Removes files that expired more than keep_stale seconds ago.
+        Returns the number of removed files.
+        """
+        limit = time() - self.ttl - self.keep_stale
+        removed = 0
+        with self._lock:
+            for entry in self._files():
+                if entry.stat().st_mtime < limit:
+                    self._remove(entry.path)
+                    removed += 1
+            self._size = None
+        _notify_evicted(self, removed)
+        return removed
+
+
+class SQLiteCache(MutableMapping):
+    """
+    Cache stored in a single SQLite database file, so all processes on a
+    host can share it.
+
+    Each entry has its own expiry time, ttl seconds after it was stored by
+    default. Expired entries are kept for revalidation until expire()
+    removes the ones expired more than keep_stale seconds ago (default: ttl).
+    The mapping interface only sees fresh entries. See InMemoryCache for
+    stale_while_revalidate and FilesystemCache for serializer and
+    blocking_io.
+    """
+    _schema = (
+        'CREATE TABLE IF NOT EXISTS entries ('
+        ' url TEXT PRIMARY KEY,'
+        ' data BLOB NOT NULL,'
+        ' etag TEXT,'
+        ' last_modified TEXT,'
+        ' expires REAL NOT NULL'
+        ')',
+        'CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)',
+    )
+    on_evict = None
+    blocking_io = True
+
+    def __init__(self, path, ttl=3600, keep_stale=None, stale_while_revalidate=0,
+                 serializer=None, timeout=10):
+        self.path = path
+        self.serializer = get_serializer(serializer)
+        self.ttl = ttl
+        self.keep_stale = ttl if keep_stale is None else keep_stale
+        self.stale_while_revalidate = stale_while_revalidate
+        self.timeout = timeout
+        self._local = local()
+        self._db  # connects and creates the schema
+
+    @property
+    def _db(self):
+        # sqlite connections can't be shared between threads or forked processes
+        pid = getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.db = self._connect()
+            self._local.pid = pid
+        return self._local.db
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        for sql in self._schema:
+            db.execute(sql)
+        return db
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            del self._local.db, self._local.pid
+
+    def __getitem__(self, url):
+        row = self._db.execute(
+            'SELECT data FROM entries WHERE url = ? AND expires > ?',
+            (url, time())).fetchone()
+        if row is None:
+            raise KeyError(url)
+        data = self._loads(url, row[0])
+        if data is None:
+            raise KeyError(url)
+        return data
+
+    def _loads(self, url, raw):
+        try:
+            return self.serializer.loads(raw)
+        except SerializationError:
+            self._db.execute('DELETE FROM entries WHERE url = ?', (url,))
+            return None
+
+    def __setitem__(self, url, data):
+        self.set_entry(url, data)
+
+    def __delitem__(self, url):
+        cur = self._db.execute('DELETE FROM entries WHERE url = ?', (url,))
+        if not cur.rowcount:
+            raise KeyError(url)
+
+    def __contains__(self, url):
+        row = self._db.execute(
+            'SELECT 1 FROM entries WHERE url = ? AND expires > ?',
+            (url, time())).fetchone()
+        return row is not None
+
+    def __iter__(self):
+        rows = self._db.execute('SELECT url FROM entries WHERE expires > ?', (time(),)).fetchall()
+        return (url for url, in rows)
 
     def __len__(self):
-        raise NotImplementedError
+        return self._db.execute('SELECT COUNT(*) FROM entries WHERE expires > ?', (time(),)).fetchone()[0]
+
+    def get_entry(self, url):
+        row = self._db.execute(
+            'SELECT data, etag, last_modified, expires FROM entries WHERE url = ?',
+            (url,)).fetchone()
+        if row is None:
+            return None
+        data, etag, last_modified, expires = row
+        data = self._loads(url, data)
+        if data is None:
+            return None
+        return CacheEntry(data, etag, last_modified, expires)
+
+    def set_entry(self, url, data, etag=None, last_modified=None, ttl=None):
+        expires = time() + (self.ttl if ttl is None else ttl)
+        self._db.execute(
+            'INSERT OR REPLACE INTO entries (url, data, etag, last_modified, expires) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (url, self.serializer.dumps(data), etag, last_modified, expires))
+
+    def expire(self):
+        """
+        Removes entries that expired more than keep_stale seconds ago.
+        Returns the number of removed entries.
+        """
+        cur = self._db.execute('DELETE FROM entries WHERE expires < ?', (time() - self.keep_stale,))
+        _notify_evicted(self, cur.rowcount)
+        return cur.rowcount
 
     def clear(self):
-        raise NotImplementedError
+        self._db.execute('DELETE FROM entries')
+
+
+def _scandir_dirs(path):
+    try:
+        entries = list(scandir(path))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if len(entry.name) == 2 and entry.is_dir():
+            yield entry
@@ -1,12 +1,24 @@
 import requests
 import logging
+import re
+import threading
 from cgi import parse_header
-from os.path import isfile
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from email.utils import formatdate, parsedate_to_datetime
+from os import getpid, replace, utime
+from os.path import getmtime, isfile
+from time import perf_counter, time
 from urllib.parse import parse_qsl as urlparse_qsl, urlencode, urlsplit, urlunsplit
+from weakref import WeakValueDictionary
 
 from .cache import InMemoryCache
-from .debugging import AplusClientDebugging, FakeResponse
-from .util import urlsplit_clean
+from .debugging import TEST_URL_PREFIX, AplusClientDebugging, FakeResponse
+from .outbox import QueuedResponse
+from .streaming import iter_json_object
+from .transport import RequestsTransport, shared_transport
+from .util import SingleFlight, canonical_url, close_response, urlsplit_clean
 
 
 NoDefault = object()
@@ -30,6 +42,8 @@ class AplusApiObject:
     """
     Base class for generic A-Plus API objects
     """
+    __slots__ = ('_client', '_source_url')
+
     def __init__(self, client, data=None, source_url=None):
         self._client = client
         self._source_url = source_url
@@ -51,6 +65,9 @@ class AplusApiObject:
             # we do not decorate anything else than dict and list
             return data
 
+        identity_map = getattr(client, 'identity_map', None)
+        if identity_map is not None and issubclass(cls, AplusApiDict):
+            return identity_map.wrap(cls, client, data, source_url)
         return cls(client=client, data=data, source_url=source_url)
 
 
@@ -58,6 +75,8 @@ class AplusApiDict(AplusApiObject):
     """
     Represents dict types returned from A-Plus API
     """
+    __slots__ = ('_data', '_url_prefix', '__weakref__')
+
     def __init__(self, *args, **kwargs):
         self._data = {}
         super().__init__(*args, **kwargs)
@@ -94,14 +113,35 @@ class AplusApiDict(AplusApiObject):
     def load_all(self):
         furl = self._full_url
         if furl and self._source_url != furl:
+            self._traversed('load_all', furl)
             data = self._client._load_cached_data(furl)
             if data:
-                self.add_data(data)
-                self._source_url = furl
-                self._update_url_prefix()
+                self._add_complete_data(data, furl)
                 return True
         return False
 
+    def _add_complete_data(self, data, url):
+        self.add_data(data)
+        self._source_url = url
+        self._update_url_prefix()
+
+    def _merge(self, data, source_url=None):
+        """
+        Merges data of the same object into this one (see IdentityMap).
+        Missing keys are added. Complete data, loaded from the url of the
+        object, also replaces the values, except for attached api objects.
+        """
+        current = self._data
+        url = data.get('url')
+        complete = source_url is not None and isinstance(url, str) and canonical_url(source_url) == canonical_url(url)
+        for key, value in data.items():
+            old = current.get(key, NoDefault)
+            if old is NoDefault or (complete and not isinstance(old, AplusApiObject)):
+                current[key] = value
+        if complete and not self.is_all_loaded:
+            self._source_url = source_url
+            self._update_url_prefix()
+
     def get_item(self, key, default=NoDefault):
         """
         Finds and returns value from dict with key
@@ -133,13 +173,22 @@ class AplusApiDict(AplusApiObject):
         converted to aplus dict
         """
         value = self.get_item(key, default=default)
-        if (key != 'url' and isinstance(value, str) and
-            self._url_prefix and value.startswith(self._url_prefix)):
+        if self._is_api_url(key, value):
+            self._traversed('link', value)
             try:
                 return self._client.load_data(value)
             except: # FIXME: too wide
                 print("ERROR: couldn't get json for %s" % (value,))
-        return AplusApiObject._wrap(self._client, value)
+        return self._wrap(self._client, value)
+
+    def _is_api_url(self, key, value):
+        return (key != 'url' and isinstance(value, str) and
+                self._url_prefix and value.startswith(self._url_prefix))
+
+    def _traversed(self, kind, url):
+        instrumentation = self._client.instrumentation
+        if instrumentation is not None:
+            instrumentation.traversal(kind, instrumentation.endpoint(url))
 
     def __getitem__(self, key):
         return self.get(key, default=NoDefault)
@@ -155,6 +204,8 @@ class AplusApiDict(AplusApiObject):
         return self._data.keys()
 
     def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError("%s has no attribute '%s'" % (self, key))
         try:
             return self[key]
         except KeyError:
@@ -164,23 +215,42 @@ class AplusApiDict(AplusApiObject):
 class AplusApiList(AplusApiObject):
     """
     Represents list types returned from A-Plus API
+
+    Elements are stored as raw data and wrapped when they are first
+    accessed, so large listings don't create a wrapper for every element
+    up front. Later accesses return the same wrapper, so the wrappers of
+    accessed elements are kept as long as the list: iterating over a whole
+    listing uses about as much memory as wrapping every element.
     """
+    __slots__ = ('_data',)
+
     def __init__(self, *args, **kwargs):
         self._data = []
         super().__init__(*args, **kwargs)
 
     def add_data(self, data):
-        for value in data:
-            self._data.append(AplusApiObject._wrap(self._client, value))
+        self._data.extend(data)
+
+    def _item(self, idx):
+        value = self._data[idx]
+        if isinstance(value, (dict, list)):
+            value = self._data[idx] = self._wrap(self._client, value)
+        return value
+
+    def _iter_from(self, start):
+        for idx in range(start, len(self._data)):
+            yield self._item(idx)
 
     def __iter__(self):
-        return iter(self._data)
+        return self._iter_from(0)
 
     def __len__(self):
         return len(self._data)
 
     def __getitem__(self, idx):
-        return self._data[idx]
+        if isinstance(idx, slice):
+            return [self._item(i) for i in range(*idx.indices(len(self._data)))]
+        return self._item(idx)
 
 
 class AplusApiPaginated(AplusApiList):
@@ -197,18 +267,36 @@ class AplusApiPaginated(AplusApiList):
         ]
     }
     """
+    __slots__ = ('_count', '_next', '_page_size', '_pagination', '_pages')
+
     def __init__(self, data, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        data = self.find_first(data)
-        self.add_data(data)
-
-    @staticmethod
-    def find_first(data):
-        previous = data['previous']
-        if previous is not None:
-            data = self._client._load_cached_data(previous)
-            previous = data['previous']
-        return data
+        self._page_size = None
+        self._pagination = None
+        # pages loaded out of order, by page index, with their own results
+        # lists, so items are wrapped once
+        self._pages = {}
+        if data['previous'] is None:
+            self.add_data(data)
+        else:
+            # a later page: the first page is loaded when needed
+            self._count = data['count']
+            self._next = self.find_first(data)
+            self._set_pagination(data['next'] or data['previous'])
+            if self._page_size is None and data['next'] is not None:
+                # only the last page may be shorter than the others
+                self._page_size = len(data['results']) or None
+            page = self._page_index(self._source_url)
+            if page is not None:
+                self._pages[page] = dict(data, results=list(data['results']))
+
+    def find_first(self, data):
+        """
+        Returns the url of the first page of the listing data is a page of
+        """
+        url, params = AplusClient.normalize_url(data['previous'])
+        params = [(k, v) for k, v in params if k not in ('offset', 'page', 'cursor')]
+        return AplusClient.join_params(url, params)
 
     @staticmethod
     def is_paginated(data, source_url=None):
@@ -218,27 +306,304 @@ class AplusApiPaginated(AplusApiList):
                 and isinstance(data['results'], list))
 
     def __iter__(self):
-        yield from self._data
-        while True:
+        yield from self._iter_from(0)
+        workers = self._client.prefetch_workers
+        urls = self._remaining_page_urls() if workers and self._next else None
+        if urls:
+            for data in self._prefetch_pages(urls, workers):
+                if data is None:
+                    break
+                at = len(self._data)
+                self.add_data(data)
+                yield from self._iter_from(at)
+        # continues with the next links after prefetched pages, if any
+        while self._next:
+            if self._client.stream_pages:
+                if not (yield from self._stream_next()):
+                    break
+                continue
             at = len(self._data)
             if not self.load_next():
                 break
-            yield from self._data[at:]
+            yield from self._iter_from(at)
+
+    def __getitem__(self, idx):
+        """
+        Returns the item at idx or a list of the items in a slice. Only the
+        pages with the items are loaded, when the pagination style (offset
+        or page number) is known.
+        """
+        if isinstance(idx, slice):
+            indices = range(*idx.indices(self._count))
+            self._load_pages(self._pages_needed(indices))
+            return [self._item_at(i) for i in indices]
+        return self._item_at(self._check_index(idx))
+
+    def _check_index(self, idx):
+        if idx < 0:
+            idx += self._count
+        if not 0 <= idx < self._count:
+            raise IndexError("%s index out of range" % (self.__class__.__name__,))
+        return idx
+
+    def _item_at(self, idx):
+        # without a known pagination style, follow the next links
+        while idx >= len(self._data) and self._page_url(0) is None:
+            url = self._next
+            if not self.load_next():
+                if url:
+                    raise self._page_error(url)
+                break
+        if idx < len(self._data):
+            return self._item(idx)
+        if self._page_url(0) is None:
+            raise IndexError("%s index out of range" % (self.__class__.__name__,))
+        page, at = divmod(idx, self._page_size)
+        url = self._page_url(page)
+        data = self._pages.get(page)
+        if data is None:
+            data = self._client._load_cached_data(url)
+            if data is None:
+                raise self._page_error(url)
+            self._add_page(page, data)
+            if idx < len(self._data):
+                return self._item(idx)
+            data = self._pages.get(page)
+        return self._page_item(data, at, url)
+
+    def _page_error(self, url):
+        return IndexError("%s page %s couldn't be loaded" % (self.__class__.__name__, url))
+
+    def _page_item(self, data, at, url):
+        try:
+            results = data['results']
+            value = results[at]
+        except (TypeError, IndexError):
+            raise IndexError("%s index out of range, page %s has no result %d" % (
+                self.__class__.__name__, url, at)) from None
+        if isinstance(value, (dict, list)):
+            value = results[at] = self._wrap(self._client, value)
+        return value
+
+    def _pages_needed(self, indices):
+        """
+        Returns the indexes of the pages, which are not loaded yet
+        """
+        if not indices or self._page_url(0) is None:
+            return []
+        loaded = len(self._data)
+        return sorted({i // self._page_size for i in indices if i >= loaded}.difference(self._pages))
+
+    def _load_pages(self, pages):
+        workers = self._client.prefetch_workers
+        if workers and len(pages) > 1:
+            urls = [self._page_url(page) for page in pages]
+            for page, data in zip(pages, self._prefetch_pages(urls, workers)):
+                self._add_page(page, data)
+
+    def _add_page(self, page, data):
+        if data is None:
+            return
+        if page * self._page_size == len(self._data):
+            self.add_data(data)
+        else:
+            self._pages[page] = dict(data, results=list(data['results']))
+            self._page_loaded(self._source_url)
+
+    def _set_pagination(self, url):
+        """
+        Finds the pagination style of the listing from a page url
+        """
+        if not url:
+            return
+        url, params = AplusClient.normalize_url(url)
+        query = dict(params)
+        if 'offset' in query or 'limit' in query:
+            key = 'offset'
+            try:
+                self._page_size = int(query['limit'])
+            except (KeyError, ValueError):
+                pass
+        elif 'page' in query:
+            key = 'page'
+        else:
+            return
+        self._pagination = (url, [(k, v) for k, v in params if k != key], key)
+
+    def _page_url(self, page):
+        """
+        Returns the url of the page (from 0), or None if the pagination
+        style is not known
+        """
+        if self._pagination is None:
+            self._set_pagination(self._next)
+            if self._pagination is None:
+                return None
+        if not self._page_size:
+            return None
+        url, params, key = self._pagination
+        if page:
+            value = page * self._page_size if key == 'offset' else page + 1
+            params = params + [(key, str(value))]
+        # like the links of the api, the first page has no offset or page
+        return AplusClient.join_params(url, sorted(params))
+
+    def _page_index(self, url):
+        if self._pagination is None or not self._page_size or not url:
+            return None
+        key = self._pagination[2]
+        try:
+            value = int(dict(AplusClient.normalize_url(url)[1]).get(key, 0 if key == 'offset' else 1))
+        except ValueError:
+            return None
+        if key == 'page':
+            return value - 1
+        # a page starting between the pages of page_size isn't kept
+        return value // self._page_size if value % self._page_size == 0 else None
+
+    def _remaining_page_urls(self):
+        """
+        Returns urls for all pages after the loaded ones, based on count
+        and the page size. Returns None if the pagination style is not known.
+        """
+        if self._page_url(0) is None or len(self._data) % self._page_size:
+            return None
+        start = len(self._data) // self._page_size
+        stop = -(-self._count // self._page_size)
+        return [self._page_url(page) for page in range(start, stop)]
+
+    def _prefetch_pages(self, urls, workers):
+        """
+        Loads pages in a thread pool and yields their data in order.
+        At most two pages per worker are requested ahead of the consumer.
+        """
+        load = self._client._load_cached_data
+        urls = iter(urls)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for url in urls:
+                    pending.append(executor.submit(load, url))
+                    if len(pending) >= workers * 2:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _stream_next(self):
+        """
+        Loads the next page and yields its results as they are parsed from
+        the response. The complete page is cached at the end. Returns False
+        if the page couldn't be loaded.
+
+        Concurrent loads of the page wait for the stream (see SingleFlight).
+        When this one waits for another load, the results are yielded once
+        the page is complete.
+        """
+        client = self._client
+        url = self._next
+        data = self._stored_next_page()
+        if data is None:
+            try:
+                data = client._cache_get(url)
+            except KeyError:
+                single_flight, key = client._flight(url)
+                future, leader = single_flight.start(key)
+                if leader:
+                    data = client._cache_peek(url)
+                    if data is None:
+                        return (yield from self._stream_page(url, single_flight, key, future))
+                    single_flight.finish(key, future, data)
+                else:
+                    data = future.result()
+                    if data is single_flight.ABANDONED:
+                        data = client._load_cached_data(url)
+        if data is None:
+            return False
+        at = len(self._data)
+        self.add_data(data)
+        yield from self._iter_from(at)
+        return True
+
+    def _stream_page(self, url, single_flight, key, future):
+        client = self._client
+        at = len(self._data)
+        page = {'results': []}
+        try:
+            resp = client._open_json_stream(url)
+            if resp is None:
+                page = None
+            else:
+                try:
+                    for name, value in client._iter_json_stream(url, resp, 'results'):
+                        if name == 'results':
+                            page['results'].append(value)
+                            self._data.append(value)
+                            yield self._item(-1)
+                        else:
+                            page[name] = value
+                finally:
+                    close_response(resp)
+        except ValueError:
+            logger.warning("Couldn't parse the json from url %s", url)
+            page = None
+        except GeneratorExit:
+            # the iteration was stopped, the page is loaded again on the next one
+            del self._data[at:]
+            single_flight.abandon(key, future)
+            raise
+        except BaseException as err:
+            del self._data[at:]
+            single_flight.finish(key, future, error=err)
+            raise
+        if page is None:
+            del self._data[at:]
+            single_flight.finish(key, future, None)
+            return False
+        self._count = page.get('count', self._count)
+        self._next = page.get('next')
+        self._page_loaded(url)
+        if 'count' in page:
+            client._cache_set(url, page, *client._response_validators(resp))
+        single_flight.finish(key, future, page)
+        return True
 
     def load_next(self):
         if self._next:
-            data = self._client._load_cached_data(self._next)
+            data = self._stored_next_page()
+            if data is None:
+                data = self._client._load_cached_data(self._next)
+            if data is None:
+                return False
             self.add_data(data)
             return True
         return False
 
+    def _stored_next_page(self):
+        """
+        Returns and forgets the next page, if it was loaded out of order
+        """
+        if self._pages and self._page_size and not len(self._data) % self._page_size:
+            return self._pages.pop(len(self._data) // self._page_size, None)
+        return None
+
     def add_data(self, data):
         if isinstance(data, dict):
             self._count = data['count']
             self._next = data['next']
             data = data['results']
+            if self._page_size is None:
+                self._page_size = len(data)
+            self._page_loaded(self._source_url)
         super().add_data(data)
 
+    def _page_loaded(self, url):
+        instrumentation = self._client.instrumentation
+        if instrumentation is not None and url:
+            instrumentation.page_loaded(instrumentation.endpoint(url))
+
     def __len__(self):
         return self._count
 
@@ -247,9 +612,11 @@ class AplusApiError(AplusApiObject):
     """
     Represents error responses from the A-Plus API
     """
+    __slots__ = ('message',)
+
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
         self.message = ''
+        super().__init__(*args, **kwargs)
 
     @staticmethod
     def is_error(data):
@@ -257,16 +624,111 @@ class AplusApiError(AplusApiObject):
                 and 'detail' in data
                 and isinstance(data['detail'], str))
 
-    def add_data(data):
+    def add_data(self, data):
         self.message = data['detail']
 
 
+class AplusApiLoadError(AplusApiError):
+    """
+    Represents an url that couldn't be loaded, see AplusClient.load_many
+    """
+    __slots__ = ('status_code', 'error')
+
+    def __init__(self, client, source_url, status_code=None, error=None):
+        super().__init__(client=client, source_url=source_url)
+        self.status_code = status_code
+        self.error = error
+        self.message = str(error) if error is not None else "Not found or not json"
+
+    def __repr__(self):
+        return "<{cls}({url}): {message}>".format(
+            cls=self.__class__.__name__,
+            url=self._source_url,
+            message=self.message,
+        )
+
+
+class IdentityMap:
+    """
+    Maps urls of api objects to their AplusApiDict wrappers, so an object
+    is wrapped once per client, however many times it's loaded or appears
+    nested in other objects. Data of later appearances is merged into the
+    existing wrapper, so data loaded by one holder (e.g. with load_all) is
+    seen by all.
+
+    The maxsize most recently used wrappers are kept, other wrappers only
+    while they are referenced elsewhere. Pass an instance to one client:
+
+        client = AplusTokenClient(token, identity_map=IdentityMap(maxsize=5000))
+    """
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._recent = OrderedDict()
+        self._alive = WeakValueDictionary()
+
+    def wrap(self, cls, client, data, source_url=None):
+        """
+        Returns the wrapper of the object in data, which is merged into an
+        existing wrapper of the same class
+        """
+        url = data.get('url')
+        if not isinstance(url, str) or not url:
+            return cls(client=client, data=data, source_url=source_url)
+        key = canonical_url(url)
+        with self._lock:
+            obj = self._recent.get(key)
+            if obj is None:
+                obj = self._alive.get(key)
+            if obj is not None and type(obj) is cls:
+                self.hits += 1
+                self._keep(key, obj)
+                obj._merge(data, source_url)
+                return obj
+            self.misses += 1
+            obj = cls(client=client, data=data, source_url=source_url)
+            self._alive[key] = obj
+            self._keep(key, obj)
+            return obj
+
+    def _keep(self, key, obj):
+        recent = self._recent
+        recent[key] = obj
+        recent.move_to_end(key)
+        if len(recent) > self.maxsize:
+            recent.popitem(last=False)
+
+    def get(self, url):
+        with self._lock:
+            key = canonical_url(url)
+            obj = self._recent.get(key)
+            return obj if obj is not None else self._alive.get(key)
+
+    def __len__(self):
+        return len(self._alive)
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+            self._alive.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._alive),
+                'recent': len(self._recent),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
 
 class AplusClientMetaclass(type):
     def __call__(cls, *args, **kwargs):
         debug = kwargs.pop('debug_enabled', False)
         if debug:
-            cls = type(cls.__name__ + 'Debuging', (AplusClientDebugging, cls), {})
+            cls = type(cls.__name__ + 'Debuging', (cls.debugging_mixin, cls), {})
         return type.__call__(cls, *args, **kwargs)
 
 
@@ -274,13 +736,77 @@ class AplusClient(metaclass=AplusClientMetaclass):
     """
     Base class for A-Plus API client.
     Handles get/post requests and converting responses to AplusApiObjects
+
+    If prefetch_workers is set, paginated responses load the remaining pages
+    in parallel using that many threads.
+
+    If stream_pages is set, results of paginated responses after the first
+    page are parsed and yielded while the response is still being read.
+
+    Concurrent loads of the same url are coalesced into a single request,
+    see single_flight for the counters.
+
+    If the cache supports get_entry() and set_entry(), expired entries are
+    revalidated with conditional requests, and served while revalidating in
+    the background within the cache's stale_while_revalidate window.
+
+    A cache shared between clients should have a lock attribute, which is
+    then used instead of the per client lock.
+
+    Requests are made through the transport (see aplus_client.transport),
+    which defaults to a new requests session per client. Clients using the
+    same transport, e.g. shared_transport(), share its connection pools.
+
+    With a policy (see aplus_client.resilience), failed requests are retried
+    and requests to failing hosts are refused by its circuit breaker.
+    With a rate_limiter (see aplus_client.ratelimit), the request rate and
+    concurrency per host are limited, including the retries.
+
+    Requests, json parsing, cache use, pages and lazy loads are reported to
+    the instrumentation, if set (see aplus_client.instrumentation).
+
+    With an identity_map (see IdentityMap), each api object is represented
+    by one AplusApiDict, which collects all data loaded for it.
+
+    If page_size is set, it's sent as page_size_param with GET requests,
+    which don't have it in the url already, so listings are loaded in pages
+    of that size. Clients sharing a cache should use the same page_size.
     """
-    def __init__(self, version=None, cache=None):
+    debugging_mixin = AplusClientDebugging
+    api_object_class = AplusApiObject
+    policy = None
+    rate_limiter = None
+    instrumentation = None
+    identity_map = None
+    page_size = None
+    page_size_param = 'limit'
+
+    def __init__(self, version=None, cache=None, prefetch_workers=0, stream_pages=False,
+                 session=None, transport=None, policy=None, rate_limiter=None,
+                 instrumentation=None, identity_map=None, page_size=None):
         self.api_version = version
         self.base_url = None
-        self.session = requests.session()
+        self.transport = RequestsTransport(session) if transport is None else transport
+        if policy is not None:
+            self.policy = policy
+        if rate_limiter is not None:
+            self.rate_limiter = rate_limiter
+        self.session = getattr(self.transport, 'session', None)
+        self.prefetch_workers = prefetch_workers
+        self.stream_pages = stream_pages
         self.__params = {}
         self._cache = InMemoryCache() if cache is None else cache
+        self._cache_lock = getattr(self._cache, 'lock', None) or threading.RLock()
+        self.single_flight = SingleFlight()
+        self._revalidating = set()
+        if instrumentation is not None:
+            self.instrumentation = instrumentation
+        if self.instrumentation is not None:
+            self.instrumentation.watch_cache(self._cache)
+        if identity_map is not None:
+            self.identity_map = identity_map
+        if page_size is not None:
+            self.page_size = page_size
 
     @staticmethod
     def api_base_url(url):
@@ -322,17 +848,24 @@ class AplusClient(metaclass=AplusClientMetaclass):
     def get_params(self):
         return self.__params
 
+    def get_params_for(self, url):
+        """
+        Returns the params for a GET request to url, including page_size
+        """
+        params = self.get_params()
+        if self.page_size and self.page_size_param not in dict(urlparse_qsl(urlsplit(url).query)):
+            params = dict(params, **{self.page_size_param: self.page_size})
+        return params
+
     def do_get(self, url, **kwargs):
         url = self._get_full_url(url)
-        kwargs['headers'] = self.get_headers()
-        kwargs['params'] = self.get_params()
+        headers = self.get_headers()
+        headers.update(kwargs.pop('headers', None) or {})
+        kwargs['headers'] = headers
+        kwargs['params'] = self.get_params_for(url)
         kwargs.setdefault('timeout', (3.2, 9.6))
         logger.debug("making GET '%s', %s", url, kwargs)
-
-        try:
-            return self.session.get(url, **kwargs)
-        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as err:
-            return ConnectionErrorResponse(err, url)
+        return self._send('GET', url, **kwargs)
 
     def do_post(self, url, data=None, json=None, timeout=None):
         assert data or json, 'You must specify either data or json'
@@ -342,58 +875,430 @@ class AplusClient(metaclass=AplusClientMetaclass):
         if not timeout:
             timeout = (3.2, 9.6)
         logger.debug("making POST '%s', headers=%r, params=%r, data=%r, json=%r", url, headers, params, data, json)
+        return self._send('POST', url,
+            headers=headers, data=data, json=json, params=params, timeout=timeout)
+
+    def _send(self, method, url, **kwargs):
+        send = partial(self.transport.request, method, url, **kwargs)
+        if self.rate_limiter is not None:
+            send = partial(self.rate_limiter.call, url, send)
+        started = perf_counter()
         try:
-            return self.session.post(url, headers=headers, data=data, json=json, params=params, timeout=timeout)
+            if self.policy is None:
+                resp = send()
+            else:
+                resp = self.policy.call(method, url, send)
         except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as err:
-            return ConnectionErrorResponse(err, url)
+            resp = ConnectionErrorResponse(err, url)
+        self._instrument_request(method, url, resp, perf_counter() - started, kwargs.get('stream'))
+        return resp
+
+    def _instrument_request(self, method, url, resp, duration, stream=False):
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return
+        size = 0
+        content = None if stream else getattr(resp, 'content', None)
+        if content is not None:
+            size = len(content)
+        else:
+            try:
+                size = int(resp.headers.get('Content-Length') or 0)
+            except ValueError:
+                pass
+        instrumentation.request(method, instrumentation.endpoint(url), resp.status_code, duration, size)
 
-    def _load_json_data(self, url):
-        resp = self.do_get(url)
+    def _load_json_data(self, url, entry=None):
+        """
+        Returns the json data and the response. With a cache entry, the
+        request is made conditional and the entry data is returned on 304.
+        """
+        headers = entry.conditional_headers() if entry is not None else None
+        resp = self.do_get(url, headers=headers)
+        return self._parse_json_response(url, resp, entry), resp
+
+    def _parse_json_response(self, url, resp, entry=None):
+        if resp.status_code == 304 and entry is not None:
+            logger.debug("not modified %r", url)
+            return entry.data
         if resp.status_code != 200:
             logger.info("Got status %d from url %s", resp.status_code, url)
             if resp.status_code == 404:
                 return None
             resp.raise_for_status()
-        return resp.json()
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return resp.json()
+        started = perf_counter()
+        data = resp.json()
+        instrumentation.json_parsed(instrumentation.endpoint(url), perf_counter() - started)
+        return data
+
+    def _open_json_stream(self, url):
+        """
+        Makes a streamed request to url and returns the response, or None
+        for 404. The caller must close the response.
+        """
+        resp = self.do_get(url, stream=True)
+        if resp.status_code != 200:
+            logger.info("Got status %d from url %s", resp.status_code, url)
+            close_response(resp)
+            if resp.status_code == 404:
+                return None
+            resp.raise_for_status()
+        return resp
+
+    def _iter_json_stream(self, url, resp, stream_key):
+        """
+        Yields the members of the json object in resp as (key, value) pairs
+        as they are parsed. Items of the stream_key array are yielded one by
+        one. The time spent reading and parsing is reported as json_parsed.
+        """
+        pairs = iter_json_object(resp.iter_content(chunk_size=16384), stream_key)
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            yield from pairs
+            return
+        seconds = 0.0
+        while True:
+            started = perf_counter()
+            try:
+                pair = next(pairs)
+            except StopIteration:
+                break
+            finally:
+                seconds += perf_counter() - started
+            yield pair
+        instrumentation.json_parsed(instrumentation.endpoint(url), seconds)
+
+    def _cache_target(self, url):
+        """
+        Returns the cache, the key and the lock used for url
+        """
+        return self._cache, url, self._cache_lock
+
+    def _cache_get(self, url):
+        cache, key, lock = self._cache_target(url)
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            with lock:
+                return cache[key]
+        try:
+            with lock:
+                data = cache[key]
+        except KeyError:
+            instrumentation.cache_event(type(cache).__name__, 'miss')
+            raise
+        instrumentation.cache_event(type(cache).__name__, 'hit')
+        return data
+
+    def _instrument_stale(self, url):
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            instrumentation.cache_event(type(self._cache_target(url)[0]).__name__, 'stale')
+
+    def _cache_get_entry(self, url):
+        cache, key, lock = self._cache_target(url)
+        get_entry = getattr(cache, 'get_entry', None)
+        if get_entry is None:
+            return None
+        with lock:
+            return get_entry(key)
+
+    def _cache_set(self, url, data, etag=None, last_modified=None):
+        cache, key, lock = self._cache_target(url)
+        with lock:
+            set_entry = getattr(cache, 'set_entry', None)
+            if set_entry is None:
+                cache[key] = data
+            else:
+                set_entry(key, data, etag=etag, last_modified=last_modified)
+
+    @staticmethod
+    def _response_validators(resp, entry=None):
+        headers = resp.headers
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if entry is not None and resp.status_code == 304:
+            etag = etag or entry.etag
+            last_modified = last_modified or entry.last_modified
+        return etag, last_modified
+
+    def _can_serve_stale(self, entry):
+        swr = getattr(self._cache, 'stale_while_revalidate', 0)
+        return bool(swr) and time() < entry.expires + swr
+
+    def _request_key(self, url):
+        return (url, tuple(sorted(self.get_params().items())))
+
+    def _flight(self, url):
+        """
+        Returns the SingleFlight and the key coalescing loads of url
+        """
+        return self.single_flight, self._request_key(url)
 
     def _load_cached_data(self, url, skip_cache=False):
         try:
             if skip_cache:
                 raise KeyError
-            data = self._cache[url]
+            data = self._cache_get(url)
         except KeyError:
-            try:
-                data = self._load_json_data(url)
-            except ValueError:
-                data = None
-            else:
-                self._cache[url] = data
+            entry = None if skip_cache else self._cache_get_entry(url)
+            if entry is not None and self._can_serve_stale(entry):
+                logger.debug("stale cache hit for %r", url)
+                self._instrument_stale(url)
+                self._revalidate_in_background(url, entry)
+                return entry.data
+            single_flight, key = self._flight(url)
+            load = self._load_and_cache if skip_cache else self._load_missing
+            data = single_flight.do(key, load, url, entry)
         else:
             logger.debug("cache hit for %r", url)
         return data
 
+    def _load_missing(self, url, entry=None):
+        """
+        Loads url, unless a load that ended just before this one started
+        already stored it in the cache
+        """
+        data = self._cache_peek(url)
+        if data is not None:
+            return data
+        return self._load_and_cache(url, entry)
+
+    def _cache_peek(self, url):
+        """
+        Returns the cached data of url or None, without instrumentation
+        """
+        cache, key, lock = self._cache_target(url)
+        with lock:
+            return cache.get(key)
+
+    def _load_and_cache(self, url, entry=None):
+        try:
+            data, resp = self._load_json_data(url, entry)
+        except ValueError:
+            return None
+        self._cache_set(url, data, *self._response_validators(resp, entry))
+        return data
+
+    def _revalidate_in_background(self, url, entry):
+        key = self._request_key(url)
+        with self._cache_lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+        thread = threading.Thread(target=self._revalidate, args=(key, url, entry), daemon=True)
+        thread.start()
+
+    def _revalidate(self, key, url, entry):
+        try:
+            single_flight, flight_key = self._flight(url)
+            single_flight.do(flight_key, self._load_missing, url, entry)
+        except Exception:
+            logger.exception("revalidation of %r failed", url)
+        finally:
+            with self._cache_lock:
+                self._revalidating.discard(key)
+
     def load_data(self, url, skip_cache=False):
         url = self._get_full_url(url)
         data = self._load_cached_data(url, skip_cache=skip_cache)
-        return AplusApiObject._wrap(client=self, data=data, source_url=url)
-
-    def load_file(self, filename, url):
-        # TODO: if-modified-sinze, cache and force support
-        if not isfile(filename):
-            url = self._get_full_url(url)
-            resp = self.do_get(url, stream=True)
-            if resp.status_code != 200:
-                return None
-            with open(filename, 'wb') as f:
-                for chunk in resp.iter_content(chunk_size=1024):
-                    if chunk:
-                        f.write(chunk)
-            header_cd = resp.headers.get('Content-Disposition')
-            if header_cd:
-                value, params = parse_header(header_cd)
-                if value == 'attachment' and 'filename' in params:
-                    filename = params['filename']
-        return filename
+        return self.api_object_class._wrap(client=self, data=data, source_url=url)
+
+    def load_many(self, urls, concurrency=8, skip_cache=False):
+        """
+        Loads many urls at once and returns the wrapped objects in the same
+        order. Each distinct url is requested once and cached data is used
+        when available. Others are loaded using up to `concurrency` threads.
+
+        Urls that can't be loaded are returned as AplusApiLoadError objects.
+        """
+        full_urls = [self._get_full_url(url) for url in urls]
+        results = {}
+        missing = []
+        for url in dict.fromkeys(full_urls):
+            try:
+                if skip_cache:
+                    raise KeyError
+                results[url] = self._cache_get(url)
+            except KeyError:
+                missing.append(url)
+        if missing:
+            load = partial(self._load_data_or_error, skip_cache=skip_cache)
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(missing))) as executor:
+                results.update(zip(missing, executor.map(load, missing)))
+        return self._wrap_many(full_urls, results)
+
+    def _load_data_or_error(self, url, skip_cache=False):
+        try:
+            data = self._load_cached_data(url, skip_cache=skip_cache)
+        except Exception as err:
+            # e.g. a malformed body, which mustn't fail the other loads
+            status_code = getattr(getattr(err, 'response', None), 'status_code', None)
+            return AplusApiLoadError(self, url, status_code, err)
+        if data is None:
+            return AplusApiLoadError(self, url)
+        return data
+
+    def _wrap_many(self, urls, results):
+        wrapped = {}
+        for url, data in results.items():
+            if data is None:
+                data = AplusApiLoadError(self, url)
+            wrapped[url] = self.api_object_class._wrap(client=self, data=data, source_url=url)
+        return [wrapped[url] for url in urls]
+
+    def prefetch(self, items, *paths, concurrency=8):
+        """
+        Loads the objects linked from items in batches and attaches them to
+        the items, so traversing the paths afterwards makes no requests:
+
+            submissions = client.prefetch(submissions, 'exercise', 'exercise.course')
+            for submission in submissions:
+                print(submission.exercise.course.name)
+
+        Paths are dotted keys. Level by level, the distinct urls of all
+        objects are loaded with one load_many: api links, partial objects
+        (which are replaced with complete ones) and the complete objects of
+        partial ones missing a key of the paths. Lists are followed item by
+        item. Loaded paginated listings are attached, but not followed.
+        Values that can't be loaded are left as they were.
+
+        Returns items as a list.
+        """
+        steps = self._prefetch_steps(items, paths)
+        try:
+            urls = next(steps)
+            while True:
+                urls = steps.send(self.load_many(urls, concurrency=concurrency))
+        except StopIteration as stop:
+            return stop.value
+
+    def _prefetch_steps(self, items, paths):
+        """
+        Generator doing the work of prefetch(). Yields lists of urls to load
+        and receives their load_many() results. Returns the items.
+        """
+        tree = {}
+        for path in paths:
+            node = tree
+            for key in path.split('.'):
+                node = node.setdefault(key, {})
+        items = list(items)
+        level = [(item, tree) for item in items if isinstance(item, AplusApiDict)]
+
+        while level:
+            # complete partial objects, which are missing keys of the paths
+            partial = {}
+            for obj, node in level:
+                if obj._full_url and not obj.is_all_loaded and any(key not in obj._data for key in node):
+                    partial.setdefault(obj._full_url, []).append(obj)
+            if partial:
+                loaded = yield list(partial)
+                for objs, data in zip(partial.values(), loaded):
+                    if isinstance(data, AplusApiDict):
+                        for obj in objs:
+                            obj._add_complete_data(data._data, data._source_url)
+
+            # links and partial objects at the keys: url -> [(container, slot, node)]
+            pending = {}
+            next_level = []
+            for obj, node in level:
+                for key, child in node.items():
+                    self._prefetch_value(obj, obj._data, key, child, pending, next_level)
+            if pending:
+                loaded = yield list(pending)
+                for targets, data in zip(pending.values(), loaded):
+                    if isinstance(data, AplusApiError):
+                        continue
+                    for container, slot, child in targets:
+                        container[slot] = data
+                        if child and isinstance(data, AplusApiDict):
+                            next_level.append((data, child))
+
+            # the same object may be reached through many parents
+            level = list({(id(obj), id(node)): (obj, node) for obj, node in next_level}.values())
+        return items
+
+    def _prefetch_value(self, obj, container, slot, node, pending, next_level):
+        value = container.get(slot) if isinstance(container, dict) else container[slot]
+        wrap = self.api_object_class._wrap
+        if isinstance(value, str):
+            if obj._is_api_url(slot, value):
+                pending.setdefault(value, []).append((container, slot, node))
+        elif isinstance(value, AplusApiDict):
+            url = value._full_url
+            if url and not value.is_all_loaded and obj._is_api_url(None, url):
+                pending.setdefault(url, []).append((container, slot, node))
+            elif node:
+                next_level.append((value, node))
+        elif isinstance(value, dict):
+            url = value.get('url')
+            if obj._is_api_url(None, url):
+                pending.setdefault(url, []).append((container, slot, node))
+            else:
+                value = container[slot] = wrap(self, value)
+                if node and isinstance(value, AplusApiDict):
+                    next_level.append((value, node))
+        elif isinstance(value, (list, AplusApiList)) and not isinstance(value, AplusApiPaginated):
+            # wrapped once, so the list keeps the attached objects
+            items = container[slot] = list(value._data if isinstance(value, AplusApiList) else value)
+            for idx in range(len(items)):
+                self._prefetch_value(obj, items, idx, node, pending, next_level)
+
+    def load_file(self, filename, url, revalidate=False, force=False):
+        """
+        Downloads url to filename, if the file doesn't exist yet.
+
+        With revalidate, an existing file is downloaded again only if the
+        resource has been modified after it (If-Modified-Since). With force,
+        the file is always downloaded.
+        """
+        exists = isfile(filename)
+        if exists and not (revalidate or force):
+            return filename
+        url = self._get_full_url(url)
+        headers = None
+        if exists and not force:
+            headers = self._file_conditional_headers(filename)
+        resp = self.do_get(url, stream=True, headers=headers)
+        if resp.status_code == 304:
+            return filename
+        if resp.status_code != 200:
+            return None
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            for chunk in resp.iter_content(chunk_size=1024):
+                if chunk:
+                    f.write(chunk)
+        replace(tmp_filename, filename)
+        self._set_file_mtime(filename, resp)
+        return self._attachment_filename(resp, filename)
+
+    @staticmethod
+    def _file_conditional_headers(filename):
+        return {'If-Modified-Since': formatdate(getmtime(filename), usegmt=True)}
+
+    @staticmethod
+    def _set_file_mtime(filename, resp):
+        # file mtime follows Last-Modified, so If-Modified-Since matches exactly
+        last_modified = resp.headers.get('Last-Modified')
+        if last_modified:
+            try:
+                mtime = parsedate_to_datetime(last_modified).timestamp()
+            except (TypeError, ValueError):
+                return
+            utime(filename, (mtime, mtime))
+
+    @staticmethod
+    def _attachment_filename(resp, default):
+        header_cd = resp.headers.get('Content-Disposition')
+        if header_cd:
+            value, params = parse_header(header_cd)
+            if value == 'attachment' and 'filename' in params:
+                return params['filename']
+        return default
 
 
 class AplusTokenClient(AplusClient):
@@ -415,18 +1320,125 @@ class AplusGraderClient(AplusClient):
     """
     Extension to A-Plus API client to support submssion_url based
     A-Plus grading backends.
+
+    With share, grader clients of the process use a common
+    transport and a common cache for exercise level data, i.e. urls with a
+    path matching shared_url_patterns. Concurrent loads of the same shared
+    url are coalesced over all grader clients. The submission and all other data is
+    cached per client, so cached data of one submission is never returned
+    for another. Keys in the shared cache include the url and the request
+    parameters, except private_params (the submission specific token).
+
+    With an outbox (see aplus_client.outbox.GradeOutbox), grade() stores
+    the result for background delivery and returns a QueuedResponse.
     """
-    def __init__(self, submission_url, **kwargs):
+    shared_url_patterns = (
+        re.compile(r'/exercises/\d+/$'),
+        re.compile(r'/courses/\d+/$'),
+    )
+    private_params = ('token',)
+    shared_cache_size = 1024
+    shared_cache_ttl = 300
+    prefetch_threads = 4
+    outbox = None
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, submission_url, share=False, outbox=None, **kwargs):
+        self.shared_cache = None
+        self.shared_single_flight = None
+        if outbox is not None:
+            self.outbox = outbox
+        if share:
+            transport, self.shared_cache, _, self.shared_single_flight = self.get_shared()
+            kwargs.setdefault('transport', transport)
         super().__init__(**kwargs)
+        if self.shared_cache is not None and self.instrumentation is not None:
+            self.instrumentation.watch_cache(self.shared_cache)
         url, params = self.normalize_url(submission_url)
         self.grading_url = url
         self.update_params(params)
+        self._grading_data = None
+
+    @classmethod
+    def get_shared(cls):
+        """
+        Returns the transport, the cache, the executor and the SingleFlight
+        shared by grader clients of this process. They are created again in
+        forked processes.
+        """
+        with cls._shared_lock:
+            shared = AplusGraderClient._shared
+            if shared is None or shared[0] != getpid():
+                # cookies set for one submission must not be sent with another
+                transport = shared_transport(block_cookies=True)
+                cache = InMemoryCache(maxsize=cls.shared_cache_size, ttl=cls.shared_cache_ttl)
+                cache.lock = threading.RLock()
+                executor = ThreadPoolExecutor(max_workers=cls.prefetch_threads)
+                shared = AplusGraderClient._shared = (getpid(), transport, cache, executor, SingleFlight())
+            return shared[1:]
+
+    @classmethod
+    def clear_shared(cls):
+        with cls._shared_lock:
+            AplusGraderClient._shared = None
+
+    def is_shared_url(self, url):
+        path = urlsplit(url).path
+        return any(pattern.search(path) for pattern in self.shared_url_patterns)
+
+    def _cache_target(self, url):
+        if self.shared_cache is not None and url != self.grading_url and self.is_shared_url(url):
+            params = sorted(
+                (key, value) for key, value in self.get_params().items()
+                if key not in self.private_params
+            )
+            if params:
+                url += ('&' if '?' in url else '?') + urlencode(params)
+            return self.shared_cache, url, self.shared_cache.lock
+        return super()._cache_target(url)
+
+    def _flight(self, url):
+        cache, key, _ = self._cache_target(url)
+        if cache is self.shared_cache and cache is not None:
+            return self.shared_single_flight, key
+        return super()._flight(url)
+
+    def prefetch_grading_data(self):
+        """
+        Starts loading grading_data in a background thread. If the load
+        hasn't started when grading_data is read, it's done inline instead.
+        """
+        if self._grading_data is None:
+            executor = self.get_shared()[2]
+            self._grading_data = executor.submit(self.load_data, self.grading_url)
+        return self._grading_data
 
     @property
     def grading_data(self):
-        data = self.load_data(self.grading_url)
-        self.__dict__['grading_data'] = data
+        data = self._grading_data
+        if data is None:
+            data = self._grading_data = self.load_data(self.grading_url)
+        elif isinstance(data, Future):
+            if data.cancel():
+                # the shared executor is busy, don't wait for a free thread
+                data = self.load_data(self.grading_url)
+            else:
+                data = data.result()
+            self._grading_data = data
         return data
 
     def grade(self, data, **kwargs):
-        return self.do_post(self.grading_url, data, **kwargs)
+        resp = self._enqueue_grade(data, **kwargs)
+        if resp is None:
+            resp = self.do_post(self.grading_url, data, **kwargs)
+        return resp
+
+    def _enqueue_grade(self, data, json=None, **kwargs):
+        if self.outbox is None or self.grading_url.startswith(TEST_URL_PREFIX):
+            return None
+        url = self._get_full_url(self.grading_url)
+        key = self.outbox.enqueue(url, data=data, json=json,
+                                  params=self.get_params(), headers=self.get_headers())
+        return QueuedResponse(url, key)
@@ -11,10 +11,16 @@ logger = logging.getLogger('aplus_client.client')
 
 
 class FakeResponse:
-    def __init__(self, url, status_code, text):
+    def __init__(self, url, status_code, text, headers=None):
         self.url = url
         self.status_code = status_code
         self.text = text
+        self.headers = headers if headers is not None else {}
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        content = self.text if decode_unicode else self.text.encode('utf-8')
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
 
     def json(self):
         try:
@@ -36,19 +42,45 @@ class FakeResponse:
 
 
 class AplusClientDebugging:
-    def do_get(self, url, **kwargs):
+    def _test_get(self, url):
         if url.startswith(TEST_URL_PREFIX):
             furl = url[len(TEST_URL_PREFIX):].strip('/').replace('/', '__')
             fn = ''.join((TEST_DATA_PATH, '/', furl, ".json"))
             logger.debug("making test GET '%s', file=%r", url, fn)
             with open(fn, 'r') as f:
                 return FakeResponse(fn, 200, f.read())
-        return super().do_get(url, **kwargs)
+        return None
 
-    def do_post(self, url, data, **kwargs):
+    def _test_post(self, url, data):
         if url.startswith(TEST_URL_PREFIX):
             logger.debug("making test POST '%s', data=%r", url, data)
             return FakeResponse(url, 200, "{'result': 'accepted'}")
-        return super().do_post(url, data, **kwargs)
+        return None
+
+    def do_get(self, url, **kwargs):
+        resp = self._test_get(url)
+        if resp is None:
+            resp = super().do_get(url, **kwargs)
+        return resp
+
+    def do_post(self, url, data, **kwargs):
+        resp = self._test_post(url, data)
+        if resp is None:
+            resp = super().do_post(url, data, **kwargs)
+        return resp
+
+
+class AsyncAplusClientDebugging(AplusClientDebugging):
+    async def do_get(self, url, **kwargs):
+        resp = self._test_get(url)
+        if resp is None:
+            resp = await super(AplusClientDebugging, self).do_get(url, **kwargs)
+        return resp
+
+    async def do_post(self, url, data, **kwargs):
+        resp = self._test_post(url, data)
+        if resp is None:
+            resp = await super(AplusClientDebugging, self).do_post(url, data, **kwargs)
+        return resp
 
 
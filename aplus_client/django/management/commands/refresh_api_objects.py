@@ -0,0 +1,62 @@
+import datetime
+import os
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import CachedApiObject
+from ...refresh import refresh, refreshable_models, run_worker
+from ....client import AplusClient, AplusTokenClient
+
+
+class Command(BaseCommand):
+    help = "Refreshes outdated cached api objects from the api, oldest first"
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', metavar='app_label.Model',
+            help="Models to refresh. Defaults to models with REFRESH_IN_BACKGROUND set.")
+        parser.add_argument('--token', default=os.environ.get('APLUS_API_TOKEN'),
+            help="A+ api token. Defaults to the APLUS_API_TOKEN environment variable.")
+        parser.add_argument('--older-than', type=float, metavar='SECONDS',
+            help="Refresh rows not updated within this time. Defaults to the TTL of the model.")
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--concurrency', type=int, default=8,
+            help="Number of concurrent api requests")
+        parser.add_argument('--limit', type=int,
+            help="Maximum number of rows to refresh per round")
+        parser.add_argument('--loop', type=float, metavar='INTERVAL',
+            help="Keep running and check for outdated rows every INTERVAL seconds")
+
+    def handle(self, *args, **options):
+        models = [self.get_model(label) for label in options['models']] or refreshable_models()
+        if not models:
+            raise CommandError("No models to refresh")
+        token = options['token']
+
+        def client_factory():
+            return AplusTokenClient(token) if token else AplusClient()
+
+        kwargs = {
+            'models': models,
+            'batch_size': options['batch_size'],
+            'concurrency': options['concurrency'],
+            'limit': options['limit'],
+        }
+        if options['older_than'] is not None:
+            kwargs['older_than'] = datetime.timedelta(seconds=options['older_than'])
+
+        if options['loop'] is not None:
+            run_worker(client_factory, interval=options['loop'], **kwargs)
+        else:
+            counts = refresh(client_factory(), **kwargs)
+            self.stdout.write("Refreshed %(refreshed)d rows, %(failed)d failed" % counts)
+
+    @staticmethod
+    def get_model(label):
+        try:
+            model = apps.get_model(label)
+        except (LookupError, ValueError) as err:
+            raise CommandError(str(err))
+        if not issubclass(model, CachedApiObject):
+            raise CommandError("%s is not a cached api model" % (label,))
+        return model
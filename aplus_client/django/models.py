@@ -1,17 +1,79 @@
 import datetime
+from collections import namedtuple
 from functools import reduce
 from urllib.parse import urlsplit
 from django.apps import apps
-from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_migrate, post_save
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
+from ..client import AplusApiDict
+
+
+class ApiNamespaceManager(models.Manager):
+    """
+    Caches namespaces by hostname for the lifetime of the process.
+
+    Namespaces are cached only after the transaction they were read or
+    created in has been committed, so a rolled back namespace (e.g. at the
+    end of a TestCase) is never served from the cache. The cache is cleared
+    when namespaces are saved or deleted and after migrations (flush).
+    """
+    def __init__(self):
+        super().__init__()
+        self._cache = {}
+
+    def get_for_hostname(self, hostname):
+        try:
+            return self._cache[(self.db, hostname)]
+        except KeyError:
+            pass
+        obj, created = self.get_or_create(domain=hostname)
+        self._add_to_cache(obj)
+        return obj
+
+    def get_for_hostnames(self, hostnames):
+        """
+        Returns a dict of hostname to namespace, creating missing namespaces.
+        Uncached namespaces are fetched with a single query.
+        """
+        db = self.db
+        namespaces = {}
+        missing = set()
+        for hostname in hostnames:
+            try:
+                namespaces[hostname] = self._cache[(db, hostname)]
+            except KeyError:
+                missing.add(hostname)
+        if missing:
+            for obj in self.filter(domain__in=missing):
+                if obj.domain not in namespaces:
+                    namespaces[obj.domain] = obj
+                    self._add_to_cache(obj)
+            for hostname in missing.difference(namespaces):
+                namespaces[hostname] = self.get_for_hostname(hostname)
+        return namespaces
+
+    def _add_to_cache(self, obj):
+        db, domain = self.db, obj.domain
+
+        def add():
+            if obj.domain == domain:
+                self._cache.setdefault((db, domain), obj)
+        transaction.on_commit(add, using=db)
+
+    def clear_cache(self):
+        self._cache.clear()
+
 
 class ApiNamespace(models.Model):
     domain = models.CharField(max_length=255, db_index=True)
 
+    objects = ApiNamespaceManager()
+
     class Meta:
         abstract = apps.get_containing_app_config(__name__) is None
         verbose_name = _("Namespace")
@@ -22,19 +84,58 @@ class ApiNamespace(models.Model):
         hostname = urlsplit(url).hostname
         if not hostname:
             raise ValueError("Url doesn't have hostname")
-        obj, created = cls.objects.get_or_create(domain=hostname)
-        return obj
+        return cls.objects.get_for_hostname(hostname)
+
+    @classmethod
+    def get_map(cls, urls):
+        """
+        Returns a dict of hostname to namespace for all urls. The result can
+        be passed to the sync operations as the namespaces keyword argument.
+        """
+        hostnames = set()
+        for url in urls:
+            hostname = urlsplit(url).hostname
+            if not hostname:
+                raise ValueError("Url doesn't have hostname")
+            hostnames.add(hostname)
+        return cls.objects.get_for_hostnames(hostnames)
 
     def __str__(self):
         return self.domain
 
 
+def _clear_namespace_cache(sender, **kwargs):
+    ApiNamespace.objects.clear_cache()
+
+
+if not ApiNamespace._meta.abstract:
+    post_save.connect(_clear_namespace_cache, sender=ApiNamespace)
+    post_delete.connect(_clear_namespace_cache, sender=ApiNamespace)
+    post_migrate.connect(_clear_namespace_cache)
+
+
+def _get_namespace(url, namespaces=None):
+    """
+    Returns the namespace of url from the preloaded namespaces map if given
+    """
+    if namespaces:
+        namespace = namespaces.get(urlsplit(url).hostname)
+        if namespace is not None:
+            return namespace
+    return ApiNamespace.get_by_url(url)
+
+
 class CachedApiQuerySet(models.QuerySet):
+    bulk_batch_size = 500
+
     def get_new_or_updated(self, api_obj, **kwargs):
         obj, created = self.get_or_create(api_obj, **kwargs)
-        if not created and obj.should_be_updated:
-            self.update_object(obj, api_obj, **kwargs)
-            obj.save()
+        if not created and obj.should_be_updated_inline:
+            changed = self.update_object(obj, api_obj, **kwargs)
+            if changed is None:
+                obj.save()
+            else:
+                obj.save(update_fields=changed + ['updated'])
         return obj
 
     def get_or_create(self, api_obj, **kwargs):
@@ -54,18 +155,168 @@ class CachedApiQuerySet(models.QuerySet):
         return obj
 
     def update_object(self, obj, api_obj, **kwargs):
+        """
+        Updates obj from api_obj and returns the names of the changed fields,
+        or None if update_with doesn't return them (e.g. an override written
+        before it did), in which case all fields should be saved
+        """
+        changed = []
         if not obj.url and api_obj.url:
             obj.url = api_obj.url
-        obj.update_with(api_obj, **kwargs)
+            changed.append('url')
+        fields = obj.update_with(api_obj, **kwargs)
+        if fields is None:
+            return None
+        changed.extend(fields)
+        return changed
 
     update_object.queryset_only = True
 
+    def _api_field_names(self):
+        return ['url'] + [f.name for f in self.model._update_plan().fields]
+
+    _api_field_names.queryset_only = True
+
+    def bulk_get_new_or_updated(self, api_objs, **kwargs):
+        """
+        Bulk version of get_new_or_updated. Returns model objects in the
+        order of api_objs.
+
+        Existing rows are found with api_id__in queries, new and outdated
+        rows are written with bulk_create and bulk_update, and related
+        objects are resolved in one batch per foreign key.
+        """
+        api_objs = list(api_objs)
+        select_related = kwargs.pop('select_related', None)
+        by_id = {}
+        for api_obj in api_objs:
+            by_id.setdefault(api_obj.id, api_obj)
+
+        qs = self.select_related(*select_related) if select_related else self
+        ids = list(by_id)
+        existing = {}
+        for i in range(0, len(ids), self.bulk_batch_size):
+            chunk = ids[i:i + self.bulk_batch_size]
+            existing.update((obj.api_id, obj) for obj in qs.filter(api_id__in=chunk, **kwargs))
+
+        created = [self.model(api_id=api_id) for api_id in ids if api_id not in existing]
+        updated = [obj for obj in existing.values() if obj.should_be_updated_inline]
+        pending = [(obj, by_id[obj.api_id]) for obj in updated + created]
+        related = self._bulk_related(pending, **kwargs)
+        changed = set()
+        for obj, api_obj in pending:
+            fields = self.update_object(obj, api_obj, **dict(kwargs, **related.get(obj.api_id, {})))
+            if obj.pk is not None:
+                changed.update(self._api_field_names() if fields is None else fields)
+
+        with transaction.atomic(using=self.db):
+            if created:
+                self.bulk_create(created, batch_size=self.bulk_batch_size)
+                if any(obj.pk is None for obj in created):
+                    # backends without RETURNING (e.g. MySQL) don't set the primary keys
+                    self._set_created_pks(created, **kwargs)
+            if updated:
+                now = timezone.now()
+                for obj in updated:
+                    obj.updated = now
+                changed.add('updated')
+                self.bulk_update(updated, sorted(changed), batch_size=self.bulk_batch_size)
+
+        objs = dict(existing)
+        objs.update((obj.api_id, obj) for obj in created)
+        return [objs[api_obj.id] for api_obj in api_objs]
+
+    def _set_created_pks(self, created, **kwargs):
+        pks = {}
+        for i in range(0, len(created), self.bulk_batch_size):
+            chunk = [obj.api_id for obj in created[i:i + self.bulk_batch_size]]
+            pks.update(self.filter(api_id__in=chunk, **kwargs).values_list('api_id', 'pk'))
+        for obj in created:
+            obj.pk = pks.get(obj.api_id)
+
+    _set_created_pks.queryset_only = True
+
+    def _bulk_related(self, pending, **kwargs):
+        """
+        Resolves foreign keys of pending (obj, api_obj) pairs with one bulk
+        call per field. Partial api objects missing a key and linked urls
+        are loaded with client.load_many.
+        Returns {api_id: {field name: related object}}.
+        """
+        related = {}
+        fields = [field for field in self.model._related_api_fields() if field[0] not in kwargs]
+        if not fields or not pending:
+            return related
+        client = pending[0][1]._client
+        partial = {}
+        for obj, api_obj in pending:
+            url = api_obj._full_url
+            if url and not api_obj.is_all_loaded and any(key not in api_obj._data for _, key, _ in fields):
+                partial.setdefault(url, []).append(api_obj)
+        if partial:
+            for api_objs, data in zip(partial.values(), client.load_many(partial)):
+                if isinstance(data, AplusApiDict):
+                    for api_obj in api_objs:
+                        api_obj._add_complete_data(data._data, data._source_url)
+
+        for name, key, model in fields:
+            values = {}
+            links = {}
+            for obj, api_obj in pending:
+                try:
+                    # partial objects are already loaded above
+                    value = api_obj._data[key]
+                except KeyError:
+                    continue
+                if api_obj._is_api_url(key, value):
+                    links[obj.api_id] = value
+                elif value is None:
+                    related.setdefault(obj.api_id, {})[name] = None
+                else:
+                    values[obj.api_id] = api_obj[key]
+            if links:
+                values.update(zip(links, client.load_many(links.values())))
+            values = {
+                api_id: value for api_id, value in values.items()
+                if isinstance(value, AplusApiDict)
+            }
+            if values:
+                objs = model.objects.bulk_get_new_or_updated(values.values(), **kwargs)
+                for api_id, rel_obj in zip(values, objs):
+                    related.setdefault(api_id, {})[name] = rel_obj
+        return related
+
+    _bulk_related.queryset_only = True
+
 
 CachedApiManager = models.Manager.from_queryset(CachedApiQuerySet)
 
 
+UpdatePlan = namedtuple('UpdatePlan', ('fields', 'related'))
+PlanField = namedtuple('PlanField', ('field', 'name', 'attname', 'key', 'model'))
+
+
+def _differs(field, current, value):
+    """
+    Compares the current value of field with a value from the api
+    """
+    if current == value:
+        return False
+    try:
+        return field.to_python(value) != current
+    except ValidationError:
+        return True
+
+
 class CachedApiObject(models.Model):
     TTL = datetime.timedelta(hours=1)
+    # model field name -> key in the api data, for fields named differently
+    API_FIELDS = {}
+    # When true, outdated rows are refreshed by aplus_client.django.refresh
+    # (the refresh_api_objects command) and are returned as is until they
+    # are older than TTL + MAX_STALENESS. None allows any staleness.
+    REFRESH_IN_BACKGROUND = False
+    MAX_STALENESS = None
 
     class Meta:
         abstract = True
@@ -80,34 +331,74 @@ class CachedApiObject(models.Model):
         age = timezone.now() - self.updated
         return age > self.TTL
 
+    @property
+    def should_be_updated_inline(self):
+        if not self.REFRESH_IN_BACKGROUND:
+            return self.should_be_updated
+        if self.MAX_STALENESS is None:
+            return False
+        age = timezone.now() - self.updated
+        return age > self.TTL + self.MAX_STALENESS
+
     def update_using(self, client):
         data = client.load_data(self.url)
-        self.update_with(data)
+        return self.update_with(data)
 
-    def update_with(self, api_obj, **kwargs):
-        fields = (
-            (f, f.name, f.related_model)
-            for f in self._meta.get_fields()
-            if (
-                f.concrete and (
-                    not f.is_relation
-                    or f.one_to_one
-                    or (f.many_to_one and f.related_model)
-                ) and
-                f.name not in ('id', 'url', 'updated')
+    @classmethod
+    def _update_plan(cls):
+        """
+        Returns the fields updated from the api, built once per model class
+        """
+        plan = cls.__dict__.get('_update_plan_cache')
+        if plan is None:
+            fields = tuple(
+                PlanField(f, f.name, f.attname, cls.API_FIELDS.get(f.name, f.name), f.related_model)
+                for f in cls._meta.get_fields()
+                if (
+                    f.concrete and (
+                        not f.is_relation
+                        or f.one_to_one
+                        or (f.many_to_one and f.related_model)
+                    ) and
+                    f.name not in ('id', 'url', 'updated')
+                )
             )
-        )
-        for f, name, model in fields:
-            if name in kwargs:
-                setattr(self, name, kwargs[name])
-                continue
-            try:
-                value = api_obj[name]
-            except KeyError:
-                continue
-            if model:
-                value = model.objects.get_new_or_updated(value, **kwargs)
-            setattr(self, name, value)
+            plan = UpdatePlan(fields, tuple(f for f in fields if f.model))
+            cls._update_plan_cache = plan
+        return plan
+
+    @classmethod
+    def _related_api_fields(cls):
+        return [(f.name, f.key, f.model) for f in cls._update_plan().related]
+
+    def update_with(self, api_obj, **kwargs):
+        """
+        Sets fields from api_obj, or from kwargs by field name. Only values
+        that differ from the current ones are set. Returns the names of the
+        changed fields.
+        """
+        changed = []
+        for f in self._update_plan().fields:
+            if f.name in kwargs:
+                value = kwargs[f.name]
+            else:
+                try:
+                    value = api_obj[f.key]
+                except KeyError:
+                    continue
+                if f.model:
+                    value = f.model.objects.get_new_or_updated(value, **kwargs)
+            if f.model:
+                if value is None:
+                    differs = getattr(self, f.attname) is not None
+                else:
+                    differs = value.pk is None or getattr(self, f.attname) != value.pk
+            else:
+                differs = _differs(f.field, getattr(self, f.attname), value)
+            if differs:
+                setattr(self, f.name, value)
+                changed.append(f.name)
+        return changed
 
 
 class NamespacedApiQuerySet(CachedApiQuerySet):
@@ -119,22 +410,25 @@ class NamespacedApiQuerySet(CachedApiQuerySet):
     def using_namespace_id(self, namespace_id):
         return self.filter(namespace_id=namespace_id)
 
-    def get_new_or_updated(self, api_obj, **kwargs):
+    def get_new_or_updated(self, api_obj, namespaces=None, **kwargs):
         if 'namespace' not in kwargs:
-            kwargs['namespace'] = ApiNamespace.get_by_url(api_obj.url)
+            kwargs['namespace'] = _get_namespace(api_obj.url, namespaces)
         return super().get_new_or_updated(api_obj, **kwargs)
 
-    def update_object(self, obj, api_obj, namespace=None, **kwargs):
+    def bulk_get_new_or_updated(self, api_objs, **kwargs):
+        return _bulk_by_namespace(super().bulk_get_new_or_updated, api_objs, **kwargs)
+
+    def update_object(self, obj, api_obj, namespace=None, namespaces=None, **kwargs):
         if namespace is None:
             try:
                 namespace = obj.namespace
             except ObjectDoesNotExist:
-                namespace = ApiNamespace.get_by_url(api_obj.url)
+                namespace = _get_namespace(api_obj.url, namespaces)
         try:
             obj.namespace
         except ObjectDoesNotExist:
             obj.namespace = namespace
-        super().update_object(obj, api_obj, namespace=namespace, **kwargs)
+        return super().update_object(obj, api_obj, namespace=namespace, **kwargs)
 
 
 class NamespacedApiObject(CachedApiObject):
@@ -149,7 +443,7 @@ class NamespacedApiObject(CachedApiObject):
 
     def update_with(self, api_obj, **kwargs):
         kwargs.setdefault('namespace', self.namespace)
-        super().update_with(api_obj, **kwargs)
+        return super().update_with(api_obj, **kwargs)
 
 
 class NestedApiQuerySet(CachedApiQuerySet):
@@ -162,11 +456,40 @@ class NestedApiQuerySet(CachedApiQuerySet):
             kwargs[self.namespace_filter] = kwargs.pop('namespace')
         return super().filter(*args, **kwargs)
 
-    def get_new_or_updated(self, api_obj, **kwargs):
+    def get_new_or_updated(self, api_obj, namespaces=None, **kwargs):
         if 'namespace' not in kwargs:
-            kwargs['namespace'] = ApiNamespace.get_by_url(api_obj.url)
+            kwargs['namespace'] = _get_namespace(api_obj.url, namespaces)
         return super().get_new_or_updated(api_obj, **kwargs)
 
+    def bulk_get_new_or_updated(self, api_objs, **kwargs):
+        return _bulk_by_namespace(super().bulk_get_new_or_updated, api_objs, **kwargs)
+
+
+def _bulk_by_namespace(bulk_get_new_or_updated, api_objs, namespaces=None, **kwargs):
+    """
+    Calls bulk_get_new_or_updated once per namespace of api_objs, unless
+    the namespace is given in kwargs. Namespaces missing from the preloaded
+    namespaces map are looked up with a single query.
+    """
+    if 'namespace' in kwargs:
+        return bulk_get_new_or_updated(api_objs, **kwargs)
+    api_objs = list(api_objs)
+    groups = {}
+    for api_obj in api_objs:
+        groups.setdefault(urlsplit(api_obj.url).hostname, []).append(api_obj)
+    namespaces = dict(namespaces or ())
+    missing = set(groups).difference(namespaces)
+    if missing:
+        if None in missing:
+            raise ValueError("Url doesn't have hostname")
+        namespaces.update(ApiNamespace.objects.get_for_hostnames(missing))
+    results = {}
+    for hostname, group in groups.items():
+        namespace = namespaces[hostname]
+        objs = bulk_get_new_or_updated(group, namespace=namespace, **kwargs)
+        results.update(zip(map(id, group), objs))
+    return [results[id(api_obj)] for api_obj in api_objs]
+
 
 class NestedApiObject(CachedApiObject):
     NAMESPACE_FILTER = None
@@ -0,0 +1,132 @@
+"""
+Background refresh of outdated CachedApiObject rows.
+
+Rows are refreshed in batches, oldest first over all given models. Api data
+of a batch is loaded concurrently with client.load_many and the rows are
+then updated from the loaded objects with update_with and saved in the
+calling thread.
+
+Models with REFRESH_IN_BACKGROUND set return outdated rows from the inline
+sync path and rely on this module (or the refresh_api_objects management
+command) to keep them up to date.
+"""
+import logging
+import time
+
+from django.apps import apps
+from django.utils import timezone
+
+from ..client import AplusApiLoadError
+from .models import CachedApiObject
+
+
+logger = logging.getLogger('aplus_client.django.refresh')
+
+
+def refreshable_models():
+    """
+    Returns the installed models with REFRESH_IN_BACKGROUND set
+    """
+    return [
+        model for model in apps.get_models()
+        if issubclass(model, CachedApiObject) and model.REFRESH_IN_BACKGROUND
+    ]
+
+
+def stale_rows(model, older_than=None, now=None):
+    """
+    Returns rows of model not updated within older_than (default model.TTL)
+    before now (default the current time), oldest first
+    """
+    if older_than is None:
+        older_than = model.TTL
+    if now is None:
+        now = timezone.now()
+    return (
+        model.objects
+        .filter(updated__lt=now - older_than)
+        .exclude(url='')
+        .order_by('updated')
+    )
+
+
+def refresh_rows(objs, client, concurrency=8):
+    """
+    Refreshes objs from the api. Returns the number of refreshed rows and a
+    list of primary keys of rows that could not be refreshed.
+    """
+    refreshed = 0
+    failed = []
+    datas = client.load_many([obj.url for obj in objs], concurrency=concurrency)
+    for obj, data in zip(objs, datas):
+        if isinstance(data, AplusApiLoadError):
+            logger.warning("Failed to refresh %s from %s: %s", obj._meta.label, obj.url, data.message)
+            failed.append(obj.pk)
+            continue
+        try:
+            changed = obj.update_with(data)
+            if changed is None:
+                obj.save()
+            else:
+                obj.save(update_fields=changed + ['updated'])
+        except Exception:
+            logger.exception("Failed to refresh %s from %s", obj._meta.label, obj.url)
+            failed.append(obj.pk)
+        else:
+            refreshed += 1
+    return refreshed, failed
+
+
+def refresh(client, models=None, older_than=None, batch_size=100, concurrency=8, limit=None):
+    """
+    Refreshes outdated rows of models (default refreshable_models()) in
+    batches of batch_size. Each batch is taken from the model with the
+    oldest outdated row. At most limit rows are processed.
+
+    Rows are outdated relative to the start of the call, so rows refreshed
+    during it are not processed again.
+
+    Returns a dict with the counts of refreshed and failed rows.
+    """
+    models = refreshable_models() if models is None else list(models)
+    failed = {model: [] for model in models}
+    counts = {'refreshed': 0, 'failed': 0}
+    now = timezone.now()
+    while limit is None or counts['refreshed'] + counts['failed'] < limit:
+        oldest = []
+        for i, model in enumerate(models):
+            updated = (
+                stale_rows(model, older_than, now)
+                .exclude(pk__in=failed[model])
+                .values_list('updated', flat=True)
+                .first()
+            )
+            if updated is not None:
+                oldest.append((updated, i))
+        if not oldest:
+            break
+        model = models[min(oldest)[1]]
+        size = batch_size
+        if limit is not None:
+            size = min(size, limit - counts['refreshed'] - counts['failed'])
+        batch = list(stale_rows(model, older_than, now).exclude(pk__in=failed[model])[:size])
+        refreshed, errors = refresh_rows(batch, client, concurrency=concurrency)
+        failed[model].extend(errors)
+        counts['refreshed'] += refreshed
+        counts['failed'] += len(errors)
+        logger.debug("Refreshed %d and failed %d rows of %s", refreshed, len(errors), model._meta.label)
+    return counts
+
+
+def run_worker(client_factory, interval=60, **kwargs):
+    """
+    Calls refresh forever with a new client from client_factory on every
+    round, so cached api data is not reused between rounds. Sleeps interval
+    seconds when no rows were refreshed.
+    """
+    while True:
+        counts = refresh(client_factory(), **kwargs)
+        if counts['refreshed'] or counts['failed']:
+            logger.info("Refreshed %(refreshed)d rows, %(failed)d failed", counts)
+        if not counts['refreshed']:
+            time.sleep(interval)
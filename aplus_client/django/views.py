@@ -17,8 +17,12 @@ class AplusGraderMixin:
     """
     Django view mixin that defines grading_data if submission_url is found
     from query parameters
+
+    Set share_aplus_client to share exercise level data between the grader
+    clients of the process (see AplusGraderClient).
     """
     grading_data = None
+    share_aplus_client = False
 
     def get_aplus_client(self, request):
         submission_url = request.GET.get('submission_url', None)
@@ -54,7 +58,7 @@ class AplusGraderMixin:
         self.submission_url = submission_url
         self.post_url = post_url
         self.max_points = max_points
-        self.aplus_client = AplusGraderClient(submission_url, debug_enabled=debug)
+        self.aplus_client = AplusGraderClient(submission_url, share=self.share_aplus_client, debug_enabled=debug)
 
         # i18n
         if not language:
@@ -0,0 +1,228 @@
+"""
+Instrumentation hooks of AplusClient.
+
+The client reports events to its instrumentation (None by default, which
+costs nothing). Instrumentation does nothing by default, so subclasses only
+override the events they need. Adapters for prometheus_client and
+OpenTelemetry metrics are included:
+
+    instrumentation = PrometheusInstrumentation()  # once per process
+    client = AplusTokenClient(token, instrumentation=instrumentation)
+
+Urls are reported as endpoint templates, where ids are replaced with {id},
+e.g. /api/v2/exercises/{id}/submissions/, which keeps label cardinality low.
+"""
+import re
+import threading
+from collections import Counter, defaultdict
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+try:
+    from opentelemetry import metrics as otel_metrics
+except ImportError:
+    otel_metrics = None
+
+
+_id_segment = re.compile(r'^(\d+|[0-9a-f]{16,}|[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12})$', re.I)
+
+
+@lru_cache(maxsize=4096)
+def endpoint_template(url):
+    """
+    Returns the path of url with id segments replaced with {id}
+    """
+    path = urlsplit(url).path
+    return '/'.join('{id}' if _id_segment.match(segment) else segment for segment in path.split('/'))
+
+
+class Instrumentation:
+    """
+    Interface of the client instrumentation. Events:
+
+     - request: an http request completed, with its status (504 for
+       connection errors), duration in seconds and bytes received
+     - json_parsed: seconds spent parsing a json response
+     - cache_event: a 'hit', 'miss', 'stale' (served while revalidating) or
+       'eviction' in a cache backend (the cache class name)
+     - page_loaded: a page of a paginated listing was added
+     - traversal: AplusApiDict loaded more data lazily, kind is 'link' for a
+       followed api url and 'load_all' for loading the complete object
+    """
+    def endpoint(self, url):
+        return endpoint_template(url)
+
+    def request(self, method, endpoint, status, duration, size):
+        pass
+
+    def json_parsed(self, endpoint, duration):
+        pass
+
+    def cache_event(self, backend, event, count=1):
+        pass
+
+    def page_loaded(self, endpoint):
+        pass
+
+    def traversal(self, kind, endpoint):
+        pass
+
+    def watch_cache(self, cache):
+        """
+        Reports evictions of cache, if it supports on_evict and has no
+        other listener
+        """
+        if getattr(cache, 'on_evict', False) is None:
+            backend = type(cache).__name__
+
+            def on_evict(cache, count):
+                self.cache_event(backend, 'eviction', count)
+            cache.on_evict = on_evict
+
+
+class CountingInstrumentation(Instrumentation):
+    """
+    Keeps totals in memory, e.g. for tests and benchmarks
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = Counter()
+        self.request_seconds = defaultdict(float)
+        self.bytes = Counter()
+        self.json_seconds = defaultdict(float)
+        self.cache = Counter()
+        self.pages = Counter()
+        self.traversals = Counter()
+
+    def request(self, method, endpoint, status, duration, size):
+        with self._lock:
+            self.requests[(method, endpoint, status)] += 1
+            self.request_seconds[endpoint] += duration
+            self.bytes[endpoint] += size
+
+    def json_parsed(self, endpoint, duration):
+        with self._lock:
+            self.json_seconds[endpoint] += duration
+
+    def cache_event(self, backend, event, count=1):
+        with self._lock:
+            self.cache[(backend, event)] += count
+
+    def page_loaded(self, endpoint):
+        with self._lock:
+            self.pages[endpoint] += 1
+
+    def traversal(self, kind, endpoint):
+        with self._lock:
+            self.traversals[(kind, endpoint)] += 1
+
+
+class PrometheusInstrumentation(Instrumentation):
+    """
+    Reports to prometheus_client metrics registered in registry (default:
+    the global registry), so only one instance per registry can be created.
+    """
+    def __init__(self, registry=None, namespace='aplus_client', buckets=None):
+        if prometheus_client is None:
+            raise ImportError("PrometheusInstrumentation requires prometheus_client")
+        kwargs = {'namespace': namespace}
+        if registry is not None:
+            kwargs['registry'] = registry
+        histogram_kwargs = dict(kwargs)
+        if buckets is not None:
+            histogram_kwargs['buckets'] = buckets
+        self.request_duration = prometheus_client.Histogram(
+            'request_duration_seconds', "Duration of A+ api requests",
+            ['method', 'endpoint', 'status'], **histogram_kwargs)
+        self.response_bytes = prometheus_client.Counter(
+            'response_bytes', "Bytes received from the A+ api",
+            ['endpoint'], **kwargs)
+        self.json_parse_duration = prometheus_client.Histogram(
+            'json_parse_seconds', "Time spent parsing A+ api responses",
+            ['endpoint'], **histogram_kwargs)
+        self.cache_events = prometheus_client.Counter(
+            'cache_events', "Cache hits, misses, stale hits and evictions",
+            ['backend', 'event'], **kwargs)
+        self.pages = prometheus_client.Counter(
+            'pages', "Pages of paginated listings loaded",
+            ['endpoint'], **kwargs)
+        self.traversals = prometheus_client.Counter(
+            'traversals', "Lazy loads of linked and partial api objects",
+            ['kind', 'endpoint'], **kwargs)
+
+    def request(self, method, endpoint, status, duration, size):
+        self.request_duration.labels(method, endpoint, str(status)).observe(duration)
+        if size:
+            self.response_bytes.labels(endpoint).inc(size)
+
+    def json_parsed(self, endpoint, duration):
+        self.json_parse_duration.labels(endpoint).observe(duration)
+
+    def cache_event(self, backend, event, count=1):
+        self.cache_events.labels(backend, event).inc(count)
+
+    def page_loaded(self, endpoint):
+        self.pages.labels(endpoint).inc()
+
+    def traversal(self, kind, endpoint):
+        self.traversals.labels(kind, endpoint).inc()
+
+
+class OpenTelemetryInstrumentation(Instrumentation):
+    """
+    Reports to OpenTelemetry metrics of meter (default: the meter named
+    aplus_client from the global meter provider)
+    """
+    def __init__(self, meter=None):
+        if otel_metrics is None:
+            raise ImportError("OpenTelemetryInstrumentation requires opentelemetry-api")
+        if meter is None:
+            meter = otel_metrics.get_meter('aplus_client')
+        self.request_duration = meter.create_histogram(
+            'aplus_client.request.duration', unit='s',
+            description="Duration of A+ api requests")
+        self.response_bytes = meter.create_counter(
+            'aplus_client.response.size', unit='By',
+            description="Bytes received from the A+ api")
+        self.json_parse_duration = meter.create_histogram(
+            'aplus_client.json.parse.duration', unit='s',
+            description="Time spent parsing A+ api responses")
+        self.cache_events = meter.create_counter(
+            'aplus_client.cache.events',
+            description="Cache hits, misses, stale hits and evictions")
+        self.pages = meter.create_counter(
+            'aplus_client.pages',
+            description="Pages of paginated listings loaded")
+        self.traversals = meter.create_counter(
+            'aplus_client.traversals',
+            description="Lazy loads of linked and partial api objects")
+
+    def request(self, method, endpoint, status, duration, size):
+        attributes = {
+            'http.request.method': method,
+            'url.template': endpoint,
+            'http.response.status_code': status,
+        }
+        self.request_duration.record(duration, attributes)
+        if size:
+            self.response_bytes.add(size, {'url.template': endpoint})
+
+    def json_parsed(self, endpoint, duration):
+        self.json_parse_duration.record(duration, {'url.template': endpoint})
+
+    def cache_event(self, backend, event, count=1):
+        self.cache_events.add(count, {'backend': backend, 'event': event})
+
+    def page_loaded(self, endpoint):
+        self.pages.add(1, {'url.template': endpoint})
+
+    def traversal(self, kind, endpoint):
+        self.traversals.add(1, {'kind': kind, 'url.template': endpoint})
@@ -0,0 +1,309 @@
+"""
+Durable outbox for grading results.
+
+GradeOutbox stores results in a SQLite database and delivers them from a
+background thread, so AplusGraderClient.grade() returns immediately and
+results survive A-Plus being slow, down or the process restarting:
+
+    outbox = GradeOutbox('/var/lib/grader/outbox.sqlite3')
+    client = AplusGraderClient(submission_url, outbox=outbox)
+    client.grade({'points': 1, 'max_points': 1, 'feedback': '...'})
+
+Failed deliveries are retried with exponential backoff, or after the time
+in Retry-After. Every request carries an Idempotency-Key header, which is
+the same on every attempt. Results rejected by A-Plus (4xx) or failing
+max_attempts times are kept with failed set, see requeue_failed().
+
+The request, including its headers and parameters (e.g. the submission
+token), is stored in the database until it has been delivered.
+"""
+import logging
+import random
+import sqlite3
+import threading
+from hashlib import sha1
+from json import dumps, loads
+from os import getpid
+from time import time
+
+import requests
+
+from .debugging import FakeResponse
+from .transport import RequestsTransport
+from .util import parse_retry_after
+
+
+logger = logging.getLogger('aplus_client.outbox')
+
+RETRY_STATUS = frozenset((408, 425, 429, 500, 502, 503, 504))
+
+
+class QueuedResponse(FakeResponse):
+    """
+    Response returned for a result stored in the outbox. The status is 202
+    Accepted, and key is the idempotency key of the result.
+    """
+    def __init__(self, url, key):
+        super().__init__(url, 202, '')
+        self.key = key
+
+
+class GradeOutbox:
+    """
+    SQLite backed queue of POST requests with a background sender.
+
+    The database can be shared by processes on the same host. Due results
+    are leased for lease seconds to the process delivering them, so each is
+    sent by one process at a time. The lease of a result is renewed right
+    before it's sent, and a result whose lease was taken over by another
+    process is skipped, so lease only needs to cover one request (timeout).
+    With autostart, the sender thread is started (again after fork) when a
+    result is enqueued.
+    """
+    _schema = (
+        'CREATE TABLE IF NOT EXISTS outbox ('
+        ' id INTEGER PRIMARY KEY,'
+        ' key TEXT NOT NULL UNIQUE,'
+        ' url TEXT NOT NULL,'
+        ' request TEXT NOT NULL,'
+        ' created REAL NOT NULL,'
+        ' attempts INTEGER NOT NULL DEFAULT 0,'
+        ' next_attempt REAL NOT NULL,'
+        ' failed INTEGER NOT NULL DEFAULT 0,'
+        ' last_error TEXT'
+        ')',
+        'CREATE INDEX IF NOT EXISTS outbox_due ON outbox (failed, next_attempt)',
+    )
+
+    def __init__(self, path, transport=None, max_attempts=10, backoff=1, max_backoff=300,
+                 timeout=(3.2, 30), batch_size=10, lease=60, poll_interval=5,
+                 autostart=True, db_timeout=10):
+        self.path = path
+        self.transport = RequestsTransport(block_cookies=True) if transport is None else transport
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.autostart = autostart
+        self.db_timeout = db_timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+        self._delivered = 0
+        self._retries = 0
+        self._latency_last = None
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._db  # connects and creates the schema
+
+    @property
+    def _db(self):
+        # sqlite connections can't be shared between threads or forked processes
+        pid = getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.db = self._connect()
+            self._local.pid = pid
+        return self._local.db
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=self.db_timeout, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        for sql in self._schema:
+            db.execute(sql)
+        return db
+
+    def enqueue(self, url, data=None, json=None, params=None, headers=None, key=None):
+        """
+        Stores a POST request and returns its idempotency key. The key
+        defaults to a hash of the request, so enqueueing the same result
+        again while it's pending doesn't send it twice.
+        """
+        request = dumps({
+            'params': params or {},
+            'headers': headers or {},
+            'data': data,
+            'json': json,
+        }, sort_keys=True)
+        if key is None:
+            key = sha1((url + '\n' + request).encode('utf-8')).hexdigest()
+        now = time()
+        self._db.execute(
+            'INSERT OR IGNORE INTO outbox (key, url, request, created, next_attempt) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (key, url, request, now, now))
+        if self.autostart:
+            self.start()
+        self._wakeup.set()
+        return key
+
+    def _claim(self, now):
+        """
+        Leases a batch of due results. Returns their rows, with the end of
+        the lease as the last column.
+        """
+        db = self._db
+        leased_until = now + self.lease
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = db.execute(
+                'SELECT id, key, url, request, created, attempts FROM outbox '
+                'WHERE failed = 0 AND next_attempt <= ? ORDER BY next_attempt LIMIT ?',
+                (now, self.batch_size)).fetchall()
+            db.executemany(
+                'UPDATE outbox SET next_attempt = ? WHERE id = ?',
+                [(leased_until, row[0]) for row in rows])
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return [row + (leased_until,) for row in rows]
+
+    def _renew(self, id_, leased_until):
+        """
+        Renews the lease of a result, if it's still held. Returns False if
+        the result was delivered or leased by another process meanwhile.
+        """
+        cur = self._db.execute(
+            'UPDATE outbox SET next_attempt = ? WHERE id = ? AND failed = 0 AND next_attempt = ?',
+            (time() + self.lease, id_, leased_until))
+        return cur.rowcount == 1
+
+    def deliver_due(self):
+        """
+        Sends the results that are due. Returns the number of delivered ones.
+        """
+        return sum(self._deliver(*row) for row in self._claim(time()))
+
+    def _deliver(self, id_, key, url, request, created, attempts, leased_until):
+        if not self._renew(id_, leased_until):
+            logger.info("Lease of grading result to %s expired before it was sent", url)
+            return 0
+        request = loads(request)
+        headers = dict(request['headers'], **{'Idempotency-Key': key})
+        attempts += 1
+        retry_after = None
+        permanent = False
+        try:
+            resp = self.transport.request('POST', url,
+                headers=headers, params=request['params'],
+                data=request['data'], json=request['json'],
+                timeout=self.timeout)
+        except requests.exceptions.RequestException as err:
+            error = '%s: %s' % (err.__class__.__name__, err)
+        else:
+            if 200 <= resp.status_code < 300:
+                self._db.execute('DELETE FROM outbox WHERE id = ?', (id_,))
+                self._record_delivery(time() - created, attempts)
+                return 1
+            error = 'HTTP %d' % (resp.status_code,)
+            permanent = resp.status_code not in RETRY_STATUS
+            retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+
+        if permanent or attempts >= self.max_attempts:
+            logger.error("Giving up delivering grading result to %s after %d attempts: %s",
+                         url, attempts, error)
+            self._db.execute(
+                'UPDATE outbox SET failed = 1, attempts = ?, last_error = ? WHERE id = ?',
+                (attempts, error, id_))
+        else:
+            delay = retry_after if retry_after is not None else self._backoff(attempts)
+            logger.warning("Delivering grading result to %s failed (%s), retrying in %.1f s",
+                           url, error, delay)
+            self._db.execute(
+                'UPDATE outbox SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?',
+                (attempts, time() + delay, error, id_))
+        return 0
+
+    def _backoff(self, attempts):
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1)
+
+    def _record_delivery(self, latency, attempts):
+        with self._lock:
+            self._delivered += 1
+            self._retries += attempts - 1
+            self._latency_last = latency
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+
+    def metrics(self):
+        """
+        Returns the queue depth (pending results), the number of failed
+        results, the age of the oldest pending result and, for this process,
+        the number of delivered results, retries and delivery latency in
+        seconds from enqueue to delivery.
+        """
+        depth, oldest = self._db.execute(
+            'SELECT COUNT(*), MIN(created) FROM outbox WHERE failed = 0').fetchone()
+        failed = self._db.execute('SELECT COUNT(*) FROM outbox WHERE failed = 1').fetchone()[0]
+        with self._lock:
+            delivered = self._delivered
+            return {
+                'depth': depth,
+                'failed': failed,
+                'oldest_age': time() - oldest if oldest is not None else 0.0,
+                'delivered': delivered,
+                'retries': self._retries,
+                'latency': {
+                    'last': self._latency_last,
+                    'mean': self._latency_total / delivered if delivered else None,
+                    'max': self._latency_max if delivered else None,
+                },
+            }
+
+    def requeue_failed(self):
+        """
+        Schedules failed results to be sent again. Returns their number.
+        """
+        cur = self._db.execute(
+            'UPDATE outbox SET failed = 0, attempts = 0, next_attempt = ? WHERE failed = 1',
+            (time(),))
+        self._wakeup.set()
+        return cur.rowcount
+
+    def start(self):
+        """
+        Starts the sender thread, if it's not running in this process
+        """
+        with self._lock:
+            pid = getpid()
+            if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='aplus-grade-outbox', daemon=True)
+            self._thread_pid = pid
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None and self._thread_pid == getpid():
+            thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                delivered = self.deliver_due()
+                wait = self._next_wait() if not delivered else 0
+            except Exception:
+                logger.exception("Grade outbox sender failed")
+                wait = self.poll_interval
+            if wait > 0:
+                self._wakeup.wait(wait)
+                self._wakeup.clear()
+
+    def _next_wait(self):
+        next_attempt = self._db.execute(
+            'SELECT MIN(next_attempt) FROM outbox WHERE failed = 0').fetchone()[0]
+        if next_attempt is None:
+            return self.poll_interval
+        return max(0, min(self.poll_interval, next_attempt - time()))
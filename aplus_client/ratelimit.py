@@ -0,0 +1,205 @@
+"""
+Client side rate limiting per api host.
+
+Each host gets a token bucket (rate requests per second, bursts up to
+burst) and a cap on concurrent requests. Limits are shared by all threads
+and all clients using the same RateLimiter:
+
+    limiter = shared_rate_limiter(rate=20, max_concurrency=8)
+    client = AplusTokenClient(token, rate_limiter=limiter)
+
+With adaptive (the default), the limits follow the server (AIMD): 429 and
+503 responses, errors and responses slower than slow_threshold seconds
+halve the rate and the concurrency (at most once per cooldown), while other
+responses raise them slowly back towards the configured limits. Retry-After
+of 429 and 503 pauses all requests to the host for that time.
+"""
+import asyncio
+import threading
+from math import inf
+from os import getpid
+from time import monotonic
+from urllib.parse import urlsplit
+
+from .util import parse_retry_after
+
+
+class HostLimiter:
+    """
+    Token bucket and concurrency limit of a single host
+    """
+    poll_interval = 0.05
+
+    def __init__(self, rate=10, burst=None, max_concurrency=8, adaptive=True, min_rate=0.5,
+                 slow_threshold=5.0, decrease=0.5, increase=1.0, cooldown=1.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.adaptive = adaptive
+        self.min_rate = min_rate
+        self.slow_threshold = slow_threshold
+        self.decrease = decrease
+        self.increase = increase
+        self.cooldown = cooldown
+        self.requests = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self._cond = threading.Condition()
+        self._tokens = float(self.burst)
+        self._refilled = monotonic()
+        self._paused_until = 0.0
+        self._active = 0
+        self._last_decrease = -inf
+
+    def _try_acquire(self):
+        """
+        Takes a token and a concurrency slot and returns None, or returns
+        the seconds to wait before trying again (inf: until a release)
+        """
+        now = monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._active >= max(1, int(self.concurrency)):
+            return inf
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.rate
+        self._tokens -= 1
+        self._active += 1
+        self.requests += 1
+        return None
+
+    def acquire(self):
+        started = monotonic()
+        with self._cond:
+            while True:
+                wait = self._try_acquire()
+                if wait is None:
+                    break
+                self._cond.wait(None if wait == inf else wait)
+            self.waited += monotonic() - started
+
+    async def acquire_async(self):
+        started = monotonic()
+        while True:
+            with self._cond:
+                wait = self._try_acquire()
+                if wait is None:
+                    self.waited += monotonic() - started
+                    return
+            await asyncio.sleep(self.poll_interval if wait == inf else wait)
+
+    def release(self, resp, elapsed):
+        """
+        Releases the concurrency slot and adapts the limits to the response
+        (None when the request raised an error) and its duration
+        """
+        with self._cond:
+            self._active -= 1
+            if self.adaptive:
+                status = getattr(resp, 'status_code', None)
+                if status in (429, 503):
+                    self.throttled += 1
+                    retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+                    if retry_after:
+                        self._paused_until = max(self._paused_until, monotonic() + retry_after)
+                    self._decrease()
+                elif (resp is None or getattr(resp, 'error', None) is not None or
+                        (self.slow_threshold is not None and elapsed > self.slow_threshold)):
+                    self._decrease()
+                else:
+                    self._increase()
+            self._cond.notify_all()
+
+    def _decrease(self):
+        now = monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.concurrency = max(1.0, self.concurrency * self.decrease)
+
+    def _increase(self):
+        # about +increase per second at the current rate
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'rate': self.rate,
+                'concurrency': max(1, int(self.concurrency)),
+                'active': self._active,
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'waited': self.waited,
+            }
+
+
+class RateLimiter:
+    """
+    HostLimiters with the same options for every host. Options are passed
+    to HostLimiter.
+    """
+    def __init__(self, **options):
+        self.options = options
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def for_url(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            limiter = self._hosts.get(host)
+            if limiter is None:
+                limiter = self._hosts[host] = HostLimiter(**self.options)
+            return limiter
+
+    def call(self, url, send):
+        limiter = self.for_url(url)
+        limiter.acquire()
+        started = monotonic()
+        resp = None
+        try:
+            resp = send()
+            return resp
+        finally:
+            limiter.release(resp, monotonic() - started)
+
+    async def call_async(self, url, send):
+        limiter = self.for_url(url)
+        await limiter.acquire_async()
+        started = monotonic()
+        resp = None
+        try:
+            resp = await send()
+            return resp
+        finally:
+            limiter.release(resp, monotonic() - started)
+
+    def stats(self):
+        with self._lock:
+            hosts = dict(self._hosts)
+        return {host: limiter.stats() for host, limiter in hosts.items()}
+
+
+_shared_lock = threading.Lock()
+_shared = {}
+
+
+def shared_rate_limiter(**options):
+    """
+    Returns a RateLimiter shared within the process by all callers using
+    the same options
+    """
+    key = (getpid(),) + tuple(sorted(options.items()))
+    with _shared_lock:
+        limiter = _shared.get(key)
+        if limiter is None:
+            if any(k[0] != key[0] for k in _shared):
+                # forked, locks of the parent may be held by threads that don't exist here
+                _shared.clear()
+            limiter = _shared[key] = RateLimiter(**options)
+        return limiter
@@ -0,0 +1,295 @@
+"""
+Recording and replaying A+ api responses without network.
+
+RecordingTransport stores the responses of a real transport in an Archive,
+which is saved as a compact gzip compressed json file:
+
+    archive = Archive()
+    client = AplusTokenClient(token, transport=RecordingTransport(archive))
+    ... use the client ...
+    archive.save('course.json.gz')
+
+ReplayTransport serves the archived responses to a client:
+
+    client = AplusTokenClient(token, transport=ReplayTransport(Archive.load('course.json.gz')))
+
+Responses are matched by method, path and query parameters, so the host
+doesn't matter. Private parameters (the grader token) are not stored. See
+aplus_client.stubserver for serving an archive over http.
+"""
+import gzip
+import json
+import threading
+from hashlib import sha1
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from .aio import AsyncTransport
+from .debugging import FakeResponse
+from .transport import RequestsTransport, Transport
+
+
+NOT_FOUND = '{"detail": "Not found."}'
+
+
+class ReplayResponse(FakeResponse):
+    """
+    Fully read response returned by the replay transports
+    """
+    def __init__(self, url, status_code, text, headers=None):
+        super().__init__(url, status_code, text, headers)
+        self.content = text.encode('utf-8')
+        self.headers['Content-Length'] = str(len(self.content))
+
+    @property
+    def reason(self):
+        return 'Not Modified' if self.status_code == 304 else ''
+
+    def close(self):
+        pass
+
+
+class Archive:
+    """
+    Recorded responses by request key, see key(). Identical bodies are
+    stored once, and only the headers in kept_headers are stored.
+    """
+    version = 1
+    private_params = ('token',)
+    pagination_params = ('limit', 'offset', 'page')
+    kept_headers = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'Retry-After')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> (status, headers, body)
+        self.responses = {}
+        self.origins = set()
+
+    @classmethod
+    def key(cls, method, url, params=None, exclude=()):
+        """
+        Returns 'METHOD /path?query' with the query parameters of url and
+        params sorted, without private parameters and exclude
+        """
+        url = urlsplit(url)
+        query = parse_qsl(url.query, keep_blank_values=True)
+        if params:
+            query.extend((k, str(v)) for k, v in (params.items() if isinstance(params, dict) else params))
+        skip = set(cls.private_params).union(exclude)
+        query = sorted((k, v) for k, v in query if k not in skip)
+        key = '%s %s' % (method.upper(), url.path or '/')
+        if query:
+            key += '?' + urlencode(query)
+        return key
+
+    def add(self, method, url, status=200, body='', headers=None, params=None):
+        """
+        Adds a response. A body that isn't a str is serialized to json.
+        """
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        kept = {name.lower(): name for name in self.kept_headers}
+        headers = {
+            kept[name.lower()]: value for name, value in (headers or {}).items()
+            if name.lower() in kept
+        }
+        headers.setdefault('Content-Type', 'application/json')
+        split = urlsplit(url)
+        with self._lock:
+            if split.netloc:
+                self.origins.add('%s://%s' % (split.scheme, split.netloc))
+            self.responses[self.key(method, url, params)] = (status, headers, body)
+
+    def get(self, method, url, params=None):
+        """
+        Returns (status, headers, body) or None
+        """
+        return self.responses.get(self.key(method, url, params))
+
+    def __len__(self):
+        return len(self.responses)
+
+    def __contains__(self, key):
+        return key in self.responses
+
+    def listings(self):
+        """
+        Returns the results of the recorded paginated listings in page order
+        by the key of the listing without pagination parameters. Pages
+        recorded with different limits may overlap, which is taken into
+        account with offset pagination.
+        """
+        pages = {}
+        for key, (status, headers, body) in self.responses.items():
+            if status != 200 or not key.startswith('GET ') or '"results"' not in body:
+                continue
+            data = json.loads(body)
+            if not isinstance(data, dict) or not isinstance(data.get('results'), list) or 'count' not in data:
+                continue
+            query = dict(parse_qsl(urlsplit(key[4:]).query))
+            position = (int(query.get('offset') or 0), int(query.get('page') or 1))
+            base = self.key('GET', key[4:], exclude=self.pagination_params)
+            listing = pages.setdefault(base, {})
+            if len(data['results']) > len(listing.get(position, ())):
+                listing[position] = data['results']
+        listings = {}
+        for base, listing in pages.items():
+            combined = listings[base] = []
+            for (offset, page), results in sorted(listing.items()):
+                start = len(combined) if page > 1 else offset
+                if start <= len(combined):
+                    combined.extend(results[len(combined) - start:])
+        return listings
+
+    def dumps(self):
+        bodies = {}
+        responses = []
+        with self._lock:
+            for key, (status, headers, body) in sorted(self.responses.items()):
+                index = bodies.setdefault(body, len(bodies))
+                responses.append([key, status, headers, index])
+            origins = sorted(self.origins)
+        return json.dumps({
+            'version': self.version,
+            'origins': origins,
+            'bodies': list(bodies),
+            'responses': responses,
+        }, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, text):
+        data = json.loads(text)
+        if data.get('version') != cls.version:
+            raise ValueError("Unsupported archive version %r" % (data.get('version'),))
+        archive = cls()
+        bodies = data['bodies']
+        archive.origins.update(data['origins'])
+        for key, status, headers, index in data['responses']:
+            archive.responses[key] = (status, headers, bodies[index])
+        return archive
+
+    def save(self, path):
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            f.write(self.dumps())
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return cls.loads(f.read())
+
+
+class RecordingTransport(Transport):
+    """
+    Passes requests to transport (default: a new RequestsTransport) and
+    stores the responses in archive. Server errors (5xx) and 429 are not
+    recorded, so a replay isn't affected by a bad moment of the server, and
+    304 keeps the recorded response.
+    """
+    def __init__(self, archive, transport=None):
+        self.archive = archive
+        self.transport = RequestsTransport() if transport is None else transport
+
+    @staticmethod
+    def _record_status(status):
+        return status < 500 and status not in (304, 429)
+
+    def request(self, method, url, **kwargs):
+        resp = self.transport.request(method, url, **kwargs)
+        if kwargs.get('stream'):
+            # the body must be read for the archive, so return it read
+            content = b''.join(resp.iter_content(chunk_size=16384))
+            text = content.decode(getattr(resp, 'encoding', None) or 'utf-8', 'replace')
+            resp = ReplayResponse(resp.url, resp.status_code, text, dict(resp.headers))
+        else:
+            text = resp.text
+        if self._record_status(resp.status_code):
+            self.archive.add(method, url, resp.status_code, text, resp.headers, kwargs.get('params'))
+        return resp
+
+    def stats(self):
+        return self.transport.stats()
+
+    def close(self):
+        self.transport.close()
+
+
+class ReplayTransport(Transport):
+    """
+    Serves responses from archive. Requests that aren't in the archive get
+    404 and are counted in misses. Conditional requests get 304 when the
+    ETag or Last-Modified of the archived response matches.
+    """
+    def __init__(self, archive):
+        self.archive = archive
+        self.requests = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def request(self, method, url, params=None, headers=None, **kwargs):
+        entry = self.archive.get(method, url, params)
+        full_url = url
+        if params:
+            full_url += ('&' if urlsplit(url).query else '?') + urlencode(params)
+        with self._lock:
+            self.requests += 1
+            if entry is None:
+                self.misses += 1
+        if entry is None:
+            return ReplayResponse(full_url, 404, NOT_FOUND, {'Content-Type': 'application/json'})
+        status, entry_headers, body = entry
+        if status == 200 and _not_modified(headers or {}, entry_headers):
+            return ReplayResponse(full_url, 304, '', dict(entry_headers))
+        return ReplayResponse(full_url, status, body, dict(entry_headers))
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'misses': self.misses}
+
+
+class AsyncRecordingTransport(AsyncTransport):
+    """
+    asyncio variant of RecordingTransport wrapping an AsyncTransport
+    """
+    def __init__(self, archive, transport):
+        self.archive = archive
+        self.transport = transport
+
+    async def request(self, method, url, **kwargs):
+        resp = await self.transport.request(method, url, **kwargs)
+        if getattr(resp, 'error', None) is None and RecordingTransport._record_status(resp.status_code):
+            self.archive.add(method, url, resp.status_code, resp.text, resp.headers, kwargs.get('params'))
+        return resp
+
+    async def close(self):
+        await self.transport.close()
+
+
+class AsyncReplayTransport(AsyncTransport):
+    """
+    asyncio variant of ReplayTransport
+    """
+    def __init__(self, archive):
+        self.replay = ReplayTransport(archive)
+
+    async def request(self, method, url, **kwargs):
+        return self.replay.request(method, url, **kwargs)
+
+    def stats(self):
+        return self.replay.stats()
+
+
+def etag_for(body):
+    """
+    Returns a strong ETag for a response body
+    """
+    return '"%s"' % (sha1(body.encode('utf-8')).hexdigest()[:20],)
+
+
+def _not_modified(request_headers, response_headers):
+    request_headers = {name.lower(): value for name, value in request_headers.items()}
+    etag = response_headers.get('ETag')
+    if_none_match = request_headers.get('if-none-match')
+    if if_none_match is not None:
+        return etag is not None and (if_none_match.strip() == '*' or
+            etag in (tag.strip() for tag in if_none_match.split(',')))
+    last_modified = response_headers.get('Last-Modified')
+    return last_modified is not None and request_headers.get('if-modified-since') == last_modified
@@ -0,0 +1,237 @@
+"""
+Retries and circuit breaking for AplusClient requests.
+
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30)
+    client = AplusTokenClient(token, policy=RetryPolicy(retries=2, breaker=breaker))
+
+A policy (and its breaker) can be shared by many clients, so a host that
+keeps timing out fails fast for all of them. Requests refused by an open
+circuit raise CircuitOpenError, which the client returns as a 504
+ConnectionErrorResponse without waiting for a timeout.
+"""
+import asyncio
+import logging
+import random
+import threading
+from itertools import count
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+
+import requests
+
+from .util import close_response, parse_retry_after
+
+
+logger = logging.getLogger('aplus_client.client')
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Per host circuit breaker. After failure_threshold consecutive failures
+    the circuit opens and requests to the host are refused. After
+    reset_timeout seconds one trial request is let through (half-open):
+    success closes the circuit and failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        # host -> [consecutive failures, opened at, trial request running]
+        self._hosts = {}
+
+    def allow(self, host):
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state[1] is None:
+                return True
+            if monotonic() - state[1] < self.reset_timeout or state[2]:
+                return False
+            state[2] = True
+            return True
+
+    def record_success(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def record_failure(self, host):
+        with self._lock:
+            state = self._hosts.setdefault(host, [0, None, False])
+            state[0] += 1
+            if state[2] or state[0] >= self.failure_threshold:
+                if state[1] is None or state[2]:
+                    logger.warning("Opening circuit for %s after %d failures", host, state[0])
+                state[1] = monotonic()
+                state[2] = False
+
+    def release(self, host):
+        """
+        Ends a trial request without a result, e.g. when it was cancelled,
+        so the next request can be a trial again
+        """
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is not None:
+                state[2] = False
+
+    def state(self, host):
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state[1] is None:
+                return self.CLOSED
+            if state[2] or monotonic() - state[1] >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self.OPEN
+
+
+class RetryPolicy:
+    """
+    Retries failed requests with jittered exponential backoff.
+
+    Connection errors, timeouts and responses with a status in retry_status
+    are retried up to retries times for idempotent_methods. Other methods
+    are retried only on a status in non_idempotent_retry_status (429 by
+    default, which means the request was refused). 503 isn't included, as
+    the request may have been handled, e.g. a grading result stored.
+    Retry-After of 429 and 503 is used as the delay, unless it's longer than
+    max_retry_after, in which case the response is returned as is. No retry
+    is started if it would end after max_elapsed seconds from the start.
+
+    Connection errors, timeouts, other errors raised by send() and statuses
+    in failure_status are reported to the breaker as failures, other
+    responses as successes.
+    """
+    idempotent_methods = frozenset(('GET', 'HEAD', 'OPTIONS'))
+    retry_status = frozenset((429, 502, 503, 504))
+    non_idempotent_retry_status = frozenset((429,))
+    failure_status = frozenset((502, 503, 504))
+    errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+    def __init__(self, retries=2, backoff=0.2, max_backoff=5, max_retry_after=10,
+                 max_elapsed=30, breaker=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.max_elapsed = max_elapsed
+        self.breaker = breaker
+
+    def call(self, method, url, send):
+        """
+        Calls send() until it returns a response that isn't retried.
+        Errors raised by send() are raised when not retried.
+        """
+        host = urlsplit(url).netloc
+        started = monotonic()
+        for attempt in count():
+            self._check_circuit(host)
+            try:
+                resp = send()
+            except self.errors:
+                self._record(host, None)
+                delay = self._retry_delay(method, attempt, started)
+                if delay is None:
+                    raise
+            except Exception:
+                self._record(host, None)
+                raise
+            except BaseException:
+                self._release(host)
+                raise
+            else:
+                self._record(host, resp)
+                delay = self._retry_delay(method, attempt, started, resp)
+                if delay is None:
+                    return resp
+                close_response(resp)
+            logger.info("Retrying %s %s in %.2f s", method, url, delay)
+            sleep(delay)
+
+    async def call_async(self, method, url, send):
+        """
+        asyncio variant of call, where send() returns an awaitable
+        """
+        host = urlsplit(url).netloc
+        started = monotonic()
+        for attempt in count():
+            self._check_circuit(host)
+            try:
+                resp = await send()
+            except self.errors:
+                self._record(host, None)
+                delay = self._retry_delay(method, attempt, started)
+                if delay is None:
+                    raise
+            except Exception:
+                self._record(host, None)
+                raise
+            except BaseException:
+                self._release(host)
+                raise
+            else:
+                self._record(host, resp)
+                delay = self._retry_delay(method, attempt, started, resp)
+                if delay is None:
+                    return resp
+            logger.info("Retrying %s %s in %.2f s", method, url, delay)
+            await asyncio.sleep(delay)
+
+    def _check_circuit(self, host):
+        if self.breaker is not None and not self.breaker.allow(host):
+            raise CircuitOpenError("Circuit open for %s" % (host,))
+
+    def _release(self, host):
+        if self.breaker is not None:
+            self.breaker.release(host)
+
+    def _record(self, host, resp):
+        if self.breaker is None:
+            return
+        # error responses of the transports, see ConnectionErrorResponse
+        if resp is None or getattr(resp, 'error', None) is not None or resp.status_code in self.failure_status:
+            self.breaker.record_failure(host)
+        else:
+            self.breaker.record_success(host)
+
+    def _retry_delay(self, method, attempt, started, resp=None):
+        """
+        Returns the seconds to wait before the next attempt, or None when
+        the request should not be retried
+        """
+        if attempt >= self.retries:
+            return None
+        idempotent = method.upper() in self.idempotent_methods
+        if resp is None or getattr(resp, 'error', None) is not None:
+            if not idempotent:
+                return None
+            delay = self._backoff(attempt)
+        else:
+            status = resp.status_code
+            if status not in self.retry_status:
+                return None
+            if not idempotent and status not in self.non_idempotent_retry_status:
+                return None
+            retry_after = None
+            if status in (429, 503):
+                retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+            if retry_after is None:
+                delay = self._backoff(attempt)
+            elif retry_after > self.max_retry_after:
+                return None
+            else:
+                delay = retry_after
+        if self.max_elapsed is not None and monotonic() - started + delay > self.max_elapsed:
+            return None
+        return delay
+
+    def _backoff(self, attempt):
+        # full jitter, so clients failing at the same time don't retry together
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
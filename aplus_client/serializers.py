@@ -0,0 +1,113 @@
+"""
+Serializers for the persistent caches.
+
+Serialized data starts with a header of a magic string, the serializer id
+and its format version. Data written by another serializer or by an older
+format is detected from the header and can be discarded.
+"""
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class SerializationError(ValueError):
+    pass
+
+
+class Serializer:
+    magic = b'APC'
+    id = None
+    version = 1
+
+    @property
+    def header(self):
+        return self.magic + self.id + bytes((self.version,))
+
+    def dumps(self, data):
+        return self.header + self._dumps(data)
+
+    def loads(self, raw):
+        header = self.header
+        if raw[:len(header)] != header:
+            raise SerializationError("Unknown serialization format")
+        try:
+            return self._loads(raw[len(header):])
+        except Exception as err:
+            raise SerializationError("Invalid serialized data: %s" % (err,)) from err
+
+    def _dumps(self, data):
+        raise NotImplementedError
+
+    def _loads(self, raw):
+        raise NotImplementedError
+
+
+class JsonSerializer(Serializer):
+    id = b'j'
+
+    def _dumps(self, data):
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def _loads(self, raw):
+        return json.loads(raw.decode('utf-8'))
+
+
+class CompressedJsonSerializer(JsonSerializer):
+    """
+    zlib compressed json. Typically takes a fraction of the space of
+    plain json, for a small cpu cost.
+    """
+    id = b'z'
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def _dumps(self, data):
+        return zlib.compress(super()._dumps(data), self.level)
+
+    def _loads(self, raw):
+        return super()._loads(zlib.decompress(raw))
+
+
+class MsgpackSerializer(Serializer):
+    """
+    msgpack is both faster and more compact than json, but requires
+    the msgpack package.
+    """
+    id = b'm'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("MsgpackSerializer requires msgpack")
+
+    def _dumps(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def _loads(self, raw):
+        return msgpack.unpackb(raw, raw=False)
+
+
+SERIALIZERS = {
+    'json': JsonSerializer,
+    'zjson': CompressedJsonSerializer,
+    'msgpack': MsgpackSerializer,
+}
+
+
+def get_serializer(serializer=None):
+    """
+    Returns a serializer instance for a name in SERIALIZERS, or the
+    serializer itself if it's already an instance. Defaults to json.
+    """
+    if serializer is None:
+        serializer = 'json'
+    if isinstance(serializer, str):
+        try:
+            serializer = SERIALIZERS[serializer]()
+        except KeyError:
+            raise ValueError("Unknown serializer %r" % (serializer,))
+    return serializer
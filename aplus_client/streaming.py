@@ -0,0 +1,104 @@
+"""
+Incremental parsing of json objects from a stream of bytes
+"""
+import codecs
+import json
+import re
+
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+class _Reader:
+    """
+    Buffer over the decoded text. Consumed text is dropped as the buffer
+    is refilled, so only the unparsed part of the stream is kept in memory.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Reads more text into the buffer. Returns False at the end of stream.
+        """
+        if self.eof:
+            return False
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        for chunk in self._chunks:
+            text = self._decode(chunk)
+            if text:
+                self.buf += text
+                return True
+        self.buf += self._decode(b'', final=True)
+        self.eof = True
+        return False
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next character, or '' at the end
+        """
+        while True:
+            self.pos = _whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of %r in json stream, got %r" % (chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # numbers and literals may continue in the next chunk
+            if end == len(self.buf) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_object(chunks, stream_key):
+    """
+    Parses a json object from an iterable of bytes and yields its members
+    as (key, value) pairs as soon as they are parsed. If the value of
+    stream_key is an array, its items are yielded one by one as
+    (stream_key, item) pairs.
+    """
+    reader = _Reader(chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        if not isinstance(key, str):
+            raise ValueError("Expected a key in json stream, got %r" % (key,))
+        reader.expect(':')
+        if key == stream_key and reader.peek() == '[':
+            reader.pos += 1
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield key, reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            yield key, reader.value()
+        if reader.expect(',}') == '}':
+            break
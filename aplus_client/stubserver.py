@@ -0,0 +1,238 @@
+"""
+Local http server serving an Archive of A+ api responses.
+
+Meant for measuring clients without network: latency, page sizes, rate
+limiting (429) and server errors are configurable, and responses carry
+ETags so conditional requests get 304. Urls in the archived bodies are
+rewritten to point to the stub server.
+
+    with StubServer(Archive.load('course.json.gz'), latency=0.02, page_size=100) as server:
+        client = AplusTokenClient(token)
+        client.set_base_url_from(server.url + '/api/v2/')
+        ...
+
+or from the command line:
+
+    python -m aplus_client.stubserver course.json.gz --port 8000 --latency 0.02
+"""
+import argparse
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from .replay import NOT_FOUND, Archive, _not_modified, etag_for
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't wait for delayed acks
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.stub.handle(self)
+
+    do_HEAD = do_GET
+    do_POST = do_GET
+    do_PUT = do_GET
+    do_PATCH = do_GET
+    do_DELETE = do_GET
+
+    def log_message(self, format, *args):
+        if self.server.stub.verbose:
+            super().log_message(format, *args)
+
+
+class StubServer:
+    """
+    Serves archive on host:port (port 0 picks a free port, see url).
+
+    Each request waits latency plus a random part up to latency_jitter
+    seconds. Then throttle_rate of requests get 429 with Retry-After and
+    error_rate get error_status. With page_size, recorded paginated listings
+    are served in pages of page_size (or the limit parameter) using limit
+    and offset parameters. Requests not in the archive get 404, except
+    POSTs, which get post_body.
+    """
+    def __init__(self, archive, host='127.0.0.1', port=0, latency=0.0, latency_jitter=0.0,
+                 page_size=None, throttle_rate=0.0, retry_after=1, error_rate=0.0,
+                 error_status=503, etags=True, post_body='{}', seed=None, verbose=False):
+        self.archive = archive
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.page_size = page_size
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.etags = etags
+        self.post_body = post_body
+        self.verbose = verbose
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._rendered = {}
+        self._listings = archive.listings() if page_size else {}
+        self._thread = None
+        self.counts = {'requests': 0, 'not_modified': 0, 'throttled': 0, 'errors': 0, 'not_found': 0}
+        self.httpd = ThreadingHTTPServer((host, port), StubRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        host, port = self.httpd.server_address[:2]
+        self.url = 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='aplus-stub-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def handle(self, handler):
+        self._count('requests')
+        length = int(handler.headers.get('Content-Length') or 0)
+        if length:
+            handler.rfile.read(length)
+
+        with self._lock:
+            roll = self._random.random()
+            delay = self.latency + self._random.uniform(0, self.latency_jitter) if self.latency_jitter else self.latency
+        if delay > 0:
+            sleep(delay)
+
+        if roll < self.throttle_rate:
+            self._count('throttled')
+            return self._send(handler, 429, '{"detail": "Request was throttled."}',
+                              {'Retry-After': str(self.retry_after)})
+        if roll < self.throttle_rate + self.error_rate:
+            self._count('errors')
+            return self._send(handler, self.error_status, '{"detail": "Server error."}')
+
+        method = handler.command
+        response = self._render(method, handler.path)
+        if response is None:
+            if method == 'POST':
+                return self._send(handler, 200, self.post_body)
+            self._count('not_found')
+            return self._send(handler, 404, NOT_FOUND)
+        status, headers, body = response
+        if status == 200 and _not_modified(dict(handler.headers.items()), headers):
+            self._count('not_modified')
+            return self._send(handler, 304, '', headers)
+        return self._send(handler, status, body, headers)
+
+    def _render(self, method, path):
+        """
+        Returns (status, headers, body) for the request with urls rewritten,
+        or None. Rendered responses are kept, so each is serialized once.
+        """
+        key = Archive.key('GET' if method == 'HEAD' else method, path)
+        with self._lock:
+            rendered = self._rendered.get(key)
+        if rendered is not None:
+            return rendered
+        response = self._listing_page(key) if self._listings else None
+        if response is None:
+            response = self.archive.responses.get(key)
+            if response is None:
+                return None
+        status, headers, body = response
+        for origin in self.archive.origins:
+            body = body.replace(origin, self.url)
+        headers = dict(headers)
+        if self.etags and status == 200 and 'ETag' not in headers:
+            headers['ETag'] = etag_for(body)
+        rendered = (status, headers, body)
+        with self._lock:
+            self._rendered[key] = rendered
+        return rendered
+
+    def _listing_page(self, key):
+        path = key.split(' ', 1)[1]
+        base = Archive.key('GET', path, exclude=Archive.pagination_params)
+        results = self._listings.get(base)
+        if results is None:
+            return None
+        split = urlsplit(path)
+        query = dict(parse_qsl(split.query))
+        limit = int(query.get('limit') or self.page_size)
+        if 'offset' in query:
+            offset = int(query['offset'])
+        else:
+            offset = (int(query.get('page') or 1) - 1) * limit
+        params = parse_qsl(urlsplit(base[4:]).query)
+
+        def page_url(offset):
+            return '%s%s?%s' % (self.url, split.path, urlencode(params + [('limit', limit), ('offset', offset)]))
+
+        body = json.dumps({
+            'count': len(results),
+            'next': page_url(offset + limit) if offset + limit < len(results) else None,
+            'previous': page_url(max(0, offset - limit)) if offset > 0 else None,
+            'results': results[offset:offset + limit],
+        })
+        return 200, {'Content-Type': 'application/json'}, body
+
+    def _send(self, handler, status, body, headers=None):
+        content = body.encode('utf-8')
+        handler.send_response(status)
+        for name, value in (headers or {'Content-Type': 'application/json'}).items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(content)) if status != 304 else '0')
+        handler.end_headers()
+        if handler.command != 'HEAD' and status != 304:
+            handler.wfile.write(content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('archive', help="archive saved with Archive.save()")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each request")
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help="random extra latency up to this")
+    parser.add_argument('--page-size', type=int, help="serve listings in pages of this size")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="share of requests getting 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests getting --error-status")
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--no-etags', dest='etags', action='store_false')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    server = StubServer(
+        Archive.load(args.archive), host=args.host, port=args.port,
+        latency=args.latency, latency_jitter=args.latency_jitter, page_size=args.page_size,
+        throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+        error_rate=args.error_rate, error_status=args.error_status,
+        etags=args.etags, seed=args.seed, verbose=True)
+    print("Serving %d responses on %s" % (len(server.archive), server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
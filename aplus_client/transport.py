@@ -0,0 +1,248 @@
+"""
+Http transports for AplusClient.
+
+A transport owns the connection pools, so clients sharing a transport reuse
+connections to the same host instead of opening new ones. For example:
+
+    transport = shared_transport(pool_maxsize=20)
+    client = AplusTokenClient(token, transport=transport)
+    ...
+    transport.stats()
+    # {'hosts': {'https://plus.example.org:443': {'requests': 120, 'connections': 4, 'reused': 116}}, ...}
+
+HttpxTransport supports HTTP/2, but requires httpx (and h2 for HTTP/2).
+"""
+import threading
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from os import getpid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+def _block_cookies_policy():
+    return DefaultCookiePolicy(allowed_domains=())
+
+
+class Transport:
+    """
+    Interface of transports. request() takes the keyword arguments of
+    requests.Session.request and returns a requests.Response like object.
+    Connection errors are raised as requests exceptions.
+    """
+    def request(self, method, url, **kwargs):
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Returns connection statistics, or an empty dict if not available
+        """
+        return {}
+
+    def close(self):
+        pass
+
+
+class PoolStatsAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that keeps the request and connection counts of its
+    connection pools, including pools that have been discarded.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._closed_stats = {}
+        pools = self.poolmanager.pools
+        dispose = pools.dispose_func
+
+        def dispose_func(pool):
+            with self._stats_lock:
+                self._add_pool_stats(self._closed_stats, pool)
+            if dispose is not None:
+                dispose(pool)
+        pools.dispose_func = dispose_func
+
+    @staticmethod
+    def _add_pool_stats(stats, pool):
+        key = '%s://%s:%s' % (pool.scheme, pool.host, pool.port)
+        host = stats.setdefault(key, {'requests': 0, 'connections': 0})
+        host['requests'] += pool.num_requests
+        host['connections'] += pool.num_connections
+
+    def pool_stats(self):
+        """
+        Returns {'scheme://host:port': {'requests': n, 'connections': n, 'reused': n}}
+        """
+        with self._stats_lock:
+            stats = {key: dict(value) for key, value in self._closed_stats.items()}
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                self._add_pool_stats(stats, pool)
+        for host in stats.values():
+            host['reused'] = max(host['requests'] - host['connections'], 0)
+        return stats
+
+
+class RequestsTransport(Transport):
+    """
+    Transport using a requests session.
+
+    pool_connections is the number of hosts whose connection pools are kept,
+    pool_maxsize the number of connections kept open per host and with
+    pool_block, requests wait for a free connection instead of opening
+    extra ones. Without keep_alive, connections are closed after each
+    request. With block_cookies, cookies set by the server are ignored,
+    which should be used when the transport is shared between users.
+
+    If session is given, it's used as is.
+    """
+    def __init__(self, session=None, pool_connections=10, pool_maxsize=10,
+                 pool_block=False, keep_alive=True, block_cookies=False):
+        if session is None:
+            session = requests.session()
+            adapter = PoolStatsAdapter(
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                pool_block=pool_block,
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if not keep_alive:
+                session.headers['Connection'] = 'close'
+            if block_cookies:
+                session.cookies.set_policy(_block_cookies_policy())
+        self.session = session
+
+    def request(self, method, url, **kwargs):
+        return self.session.request(method, url, **kwargs)
+
+    def stats(self):
+        hosts = {}
+        for adapter in dict.fromkeys(self.session.adapters.values()):
+            if isinstance(adapter, PoolStatsAdapter):
+                for key, value in adapter.pool_stats().items():
+                    host = hosts.setdefault(key, {'requests': 0, 'connections': 0, 'reused': 0})
+                    for name in host:
+                        host[name] += value[name]
+        if not hosts:
+            return {}
+        return {
+            'hosts': hosts,
+            'requests': sum(host['requests'] for host in hosts.values()),
+            'connections': sum(host['connections'] for host in hosts.values()),
+            'reused': sum(host['reused'] for host in hosts.values()),
+        }
+
+    def close(self):
+        self.session.close()
+
+
+class HttpxResponse:
+    """
+    Wraps httpx.Response with the parts of the requests.Response api used
+    by the client
+    """
+    def __init__(self, response):
+        self._response = response
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    @property
+    def url(self):
+        return str(self._response.url)
+
+    @property
+    def reason(self):
+        return self._response.reason_phrase
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        try:
+            if decode_unicode:
+                yield from self._response.iter_text(chunk_size)
+            else:
+                yield from self._response.iter_bytes(chunk_size)
+        finally:
+            self._response.close()
+
+    def raise_for_status(self):
+        try:
+            self._response.raise_for_status()
+        except httpx.HTTPStatusError as err:
+            raise requests.exceptions.HTTPError(str(err), response=self) from err
+
+
+class HttpxTransport(Transport):
+    """
+    Transport using httpx with optional HTTP/2, where requests to the same
+    host are multiplexed over a single connection. The limits are passed to
+    httpx.Limits.
+    """
+    def __init__(self, http2=True, max_connections=100, max_keepalive_connections=20,
+                 keepalive_expiry=5.0, block_cookies=False, client=None):
+        if httpx is None:
+            raise ImportError("HttpxTransport requires httpx")
+        if client is None:
+            cookies = CookieJar(_block_cookies_policy()) if block_cookies else None
+            client = httpx.Client(
+                http2=http2,
+                cookies=cookies,
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive_connections,
+                    keepalive_expiry=keepalive_expiry,
+                ),
+            )
+        self.client = client
+
+    @staticmethod
+    def _timeout(timeout):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return httpx.Timeout(read, connect=connect)
+        return httpx.Timeout(timeout)
+
+    def request(self, method, url, headers=None, params=None, data=None, json=None,
+                timeout=None, stream=False):
+        try:
+            request = self.client.build_request(method, url,
+                headers=headers, params=params, data=data, json=json,
+                timeout=self._timeout(timeout))
+            response = self.client.send(request, stream=stream)
+        except httpx.TimeoutException as err:
+            raise requests.exceptions.ReadTimeout(str(err)) from err
+        except httpx.TransportError as err:
+            raise requests.exceptions.ConnectionError(str(err)) from err
+        return HttpxResponse(response)
+
+    def close(self):
+        self.client.close()
+
+
+_shared_lock = threading.Lock()
+_shared = {}
+
+
+def shared_transport(**kwargs):
+    """
+    Returns a RequestsTransport shared within the process by all callers
+    using the same options. Cookies are blocked by default, as the clients
+    sharing the transport may belong to different users.
+    """
+    kwargs.setdefault('block_cookies', True)
+    key = (getpid(),) + tuple(sorted(kwargs.items()))
+    with _shared_lock:
+        transport = _shared.get(key)
+        if transport is None:
+            if any(k[0] != key[0] for k in _shared):
+                # forked, connections of the parent must not be used
+                _shared.clear()
+            transport = _shared[key] = RequestsTransport(**kwargs)
+        return transport
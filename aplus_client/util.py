@@ -1,4 +1,9 @@
-from urllib.parse import SplitResult, urlsplit
+from concurrent.futures import Future
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from threading import Lock
+from time import time
+from urllib.parse import SplitResult, parse_qsl, urlencode, urlsplit, urlunsplit
 
 
 HOSTS_LOCALHOSTS = ('localhost', '127.0.0.1')
@@ -6,6 +11,12 @@ HOSTS_TESTDOMAIN = ('testserver', 'testserver.testserver')
 HOSTS_NONPUBLIC = HOSTS_LOCALHOSTS + HOSTS_TESTDOMAIN
 
 
+def close_response(resp):
+    close = getattr(resp, 'close', None)
+    if close is not None:
+        close()
+
+
 def is_relative_url(url):
     if not isinstance(url, SplitResult):
         url = urlsplit(url)
@@ -47,3 +58,97 @@ def urlsplit_clean(url):
     return url
 
 
+@lru_cache(maxsize=8192)
+def canonical_url(url):
+    """
+    Returns url with lower case scheme and host, sorted query parameters
+    and no fragment, so urls of the same resource compare equal
+    """
+    url = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(url.query, keep_blank_values=True)))
+    return urlunsplit((url.scheme.lower(), url.netloc.lower(), url.path, query, ''))
+
+
+def parse_retry_after(value):
+    """
+    Returns the delay in seconds of a Retry-After header value, which is
+    either seconds or a http date. Returns None for missing or bad values.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls with the same key. The first caller runs
+    the function and the others wait for it and share its result or error.
+
+    `calls` counts the calls that ran the function and `coalesced` the calls
+    that waited for another one instead.
+
+    Callers that can't run the work as a function (e.g. it yields results
+    while running) use start() and finish() or abandon() instead of do().
+    """
+    # result of an abandoned call, the waiters run the call again
+    ABANDONED = object()
+
+    def __init__(self):
+        self._lock = Lock()
+        self._futures = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        while True:
+            future, leader = self.start(key)
+            if leader:
+                break
+            result = future.result()
+            if result is not self.ABANDONED:
+                return result
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as err:
+            self.finish(key, future, error=err)
+            raise
+        self.finish(key, future, result)
+        return result
+
+    def start(self, key):
+        """
+        Returns the future of the call with key and whether the caller leads
+        it. The leader must end the call with finish() or abandon(), and the
+        others wait for the future.
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                future = self._futures[key] = Future()
+                self.calls += 1
+                return future, True
+            self.coalesced += 1
+            return future, False
+
+    def finish(self, key, future, result=None, error=None):
+        with self._lock:
+            del self._futures[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def abandon(self, key, future):
+        """
+        Ends the call without a result, so the waiters run it themselves
+        """
+        self.finish(key, future, self.ABANDONED)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Get and set times of the cache backends at different sizes.
+
+For each size n, n submissions are stored and read back:
+ - memory: InMemoryCache set, get (hits), and set of n more entries, which
+   evicts the first n
+ - filesystem: FilesystemCache set, warm get (from the same instance) and
+   cold get (from a new instance, so data is read from disk)
+ - sqlite: SQLiteCache set, warm get and cold get (a new connection)
+
+Run from the repository root:
+
+    python benchmarks/caches.py --sizes 100 1000 10000 -o caches.json
+"""
+import argparse
+import shutil
+import tempfile
+from os.path import join
+
+import common
+from aplus_client.cache import FilesystemCache, InMemoryCache, SQLiteCache
+
+
+def fill(cache, keys, data):
+    for key in keys:
+        cache[key] = data
+
+
+def read(cache, keys):
+    for key in keys:
+        cache[key]
+
+
+def per_op(seconds, n):
+    return {'seconds': seconds, 'us_per_op': round(seconds['median'] / n * 1e6, 3)}
+
+
+def memory(n, data, repeat):
+    keys = ['%ssubmissions/%d/' % (common.API, i) for i in range(n)]
+    more = ['%ssubmissions/%d/' % (common.API, i) for i in range(n, 2 * n)]
+
+    def new():
+        return InMemoryCache(maxsize=n, ttl=3600)
+
+    def filled():
+        cache = new()
+        fill(cache, keys, data)
+        return cache
+
+    return {
+        'set': per_op(common.timed(lambda cache: fill(cache, keys, data), repeat, new)[0], n),
+        'get': per_op(common.timed(lambda cache: read(cache, keys), repeat, filled)[0], n),
+        'evict': per_op(common.timed(lambda cache: fill(cache, more, data), repeat, filled)[0], n),
+    }
+
+
+def disk(n, data, repeat, make):
+    """
+    make(path) returns a cache stored in path
+    """
+    keys = ['%ssubmissions/%d/' % (common.API, i) for i in range(n)]
+    tmp = tempfile.mkdtemp(prefix='aplus-bench-')
+    paths = (join(tmp, str(i)) for i in range(1000000))
+    try:
+        def filled(path=None):
+            cache = make(path or next(paths))
+            fill(cache, keys, data)
+            return cache
+
+        def reopened():
+            path = next(paths)
+            filled(path)
+            return make(path)
+
+        def new():
+            return make(next(paths))
+
+        return {
+            'set': per_op(common.timed(lambda cache: fill(cache, keys, data), repeat, new)[0], n),
+            'warm_get': per_op(common.timed(lambda cache: read(cache, keys), repeat, filled)[0], n),
+            'cold_get': per_op(common.timed(lambda cache: read(cache, keys), repeat, reopened)[0], n),
+        }
+    finally:
+        shutil.rmtree(tmp)
+
+
+def run(sizes=(100, 1000, 10000), repeat=3, disk_limit=10000):
+    data = common.submission(1)
+    results = {}
+    for n in sizes:
+        results['memory.%d' % n] = memory(n, data, repeat)
+        if n <= disk_limit:
+            results['filesystem.%d' % n] = disk(
+                n, data, repeat, lambda path: FilesystemCache(path, maxsize=n, ttl=3600))
+            results['sqlite.%d' % n] = disk(
+                n, data, repeat, lambda path: SQLiteCache(path + '.sqlite3', ttl=3600))
+    return common.report('caches', {'sizes': list(sizes), 'repeat': repeat, 'disk_limit': disk_limit}, results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--disk-limit', type=int, default=10000,
+                        help="largest size measured with the disk backed caches")
+    parser.add_argument('-o', '--output', help="file for the json results (default: stdout)")
+    args = parser.parse_args()
+    common.write(run(args.sizes, args.repeat, args.disk_limit), args.output)
+
+
+if __name__ == '__main__':
+    main()
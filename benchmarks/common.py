@@ -0,0 +1,189 @@
+"""
+Shared data and helpers of the benchmarks.
+
+Every benchmark writes a json document with the same layout, so results of
+two versions can be compared with compare.py:
+
+    {"benchmark": "caches", "params": {...}, "meta": {...}, "results": {...}}
+
+This module only needs the client of the first version with the benchmarks,
+so memory.py also runs on older commits. The other benchmarks use newer
+apis (e.g. replay) and run only on versions having them.
+"""
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from aplus_client import __version__  # noqa: E402
+from aplus_client.cache import InMemoryCache  # noqa: E402
+from aplus_client.client import AplusClient  # noqa: E402
+from aplus_client.debugging import FakeResponse  # noqa: E402
+try:
+    from aplus_client.replay import Archive, ReplayTransport  # noqa: E402
+except ImportError:
+    # older versions, see the module docstring
+    Archive = ReplayTransport = None
+
+
+API = 'https://plus.example.org/api/v2/'
+EXERCISES = 50
+USERS = 2000
+
+
+def submission(i):
+    return {
+        'id': i,
+        'url': '%ssubmissions/%d/' % (API, i),
+        'html_url': 'https://plus.example.org/course/instance/module/exercise/submissions/%d/' % (i,),
+        'submission_time': '2024-01-01T12:00:00Z',
+        'grade': i % 100,
+        'exercise': {
+            'id': i % EXERCISES,
+            'url': '%sexercises/%d/' % (API, i % EXERCISES),
+            'display_name': 'Exercise %d' % (i % EXERCISES,),
+        },
+        'submitters': [{'id': i % USERS, 'url': '%susers/%d/' % (API, i % USERS)}],
+    }
+
+
+def exercise(i):
+    return {
+        'id': i,
+        'url': '%sexercises/%d/' % (API, i),
+        'display_name': 'Exercise %d' % (i,),
+        'max_points': 10 + i % 5,
+        'max_submissions': 10,
+        'course': '%scourses/%d/' % (API, i % 3),
+    }
+
+
+def course(i):
+    return {
+        'id': i,
+        'url': '%scourses/%d/' % (API, i),
+        'code': 'CS-%d' % (i,),
+        'name': 'Course %d' % (i,),
+    }
+
+
+def page_url(offset, limit):
+    return '%ssubmissions/?limit=%d&offset=%d' % (API, limit, offset)
+
+
+def render_pages(count, page_size):
+    """
+    Returns json texts by url: the pages of a submission listing and the
+    exercises and courses they link to
+    """
+    pages = {}
+    for offset in range(0, count, page_size):
+        nxt = offset + page_size
+        pages[page_url(offset, page_size)] = json.dumps({
+            'count': count,
+            'next': page_url(nxt, page_size) if nxt < count else None,
+            'previous': page_url(offset - page_size, page_size) if offset else None,
+            'results': [submission(i) for i in range(offset, min(nxt, count))],
+        })
+    for i in range(EXERCISES):
+        pages['%sexercises/%d/' % (API, i)] = json.dumps(exercise(i))
+    for i in range(3):
+        pages['%scourses/%d/' % (API, i)] = json.dumps(course(i))
+    return pages
+
+
+def _require_replay():
+    if Archive is None:
+        raise RuntimeError("aplus_client.replay is needed, this benchmark doesn't run on version %s" % (
+            __version__,))
+
+
+def pages_archive(pages):
+    _require_replay()
+    archive = Archive()
+    for url, text in pages.items():
+        archive.add('GET', url, 200, text)
+    return archive
+
+
+def replay_client(archive, **kwargs):
+    """
+    Returns a client making its requests to archive through the full
+    request path, without network
+    """
+    _require_replay()
+    kwargs.setdefault('cache', InMemoryCache(maxsize=len(archive)))
+    return AplusClient(transport=ReplayTransport(archive), **kwargs)
+
+
+class PagesClient(AplusClient):
+    """
+    Client serving pre-rendered json pages, so parsing is still measured
+    """
+    def __init__(self, pages, **kwargs):
+        kwargs.setdefault('cache', InMemoryCache(maxsize=len(pages)))
+        super().__init__(**kwargs)
+        self.pages = pages
+
+    def do_get(self, url, **kwargs):
+        return FakeResponse(url, 200, self.pages[url])
+
+
+def timed(func, repeat=5, setup=None):
+    """
+    Calls setup() (if given) and func(setup result) repeat times and returns
+    the min, median and max seconds of the func calls and the last result
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        gc.collect()
+        start = time.perf_counter()
+        result = func(arg) if setup is not None else func()
+        times.append(time.perf_counter() - start)
+    return {
+        'min': round(min(times), 6),
+        'median': round(statistics.median(times), 6),
+        'max': round(max(times), 6),
+    }, result
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def meta():
+    return {
+        'version': __version__,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def report(benchmark, params, results):
+    return {'benchmark': benchmark, 'params': params, 'meta': meta(), 'results': results}
+
+
+def write(document, output=None):
+    if output:
+        with open(output, 'w') as f:
+            json.dump(document, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(document, sys.stdout, indent=2)
+        sys.stdout.write('\n')
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Compares two json results of the benchmarks.
+
+Prints the metrics found in both files with the relative change. Times are
+compared by their median. Changes larger than the threshold are marked as
+better or worse; items_per_second is better when higher, the other metrics
+when lower.
+
+    python benchmarks/compare.py before.json after.json --threshold 0.1
+
+With --fail, the exit status is 1 if any time got worse.
+"""
+import argparse
+import json
+import sys
+
+
+HIGHER_IS_BETTER = ('items_per_second',)
+SKIPPED = ('min', 'max')
+
+
+def flatten(value, prefix=''):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in SKIPPED or key == 'params':
+                continue
+            if key == 'results':
+                # results of run_all.py are nested by benchmark
+                name = prefix
+            else:
+                name = prefix + '.' + key if prefix else key
+            yield from flatten(item, name)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def metrics(path):
+    with open(path) as f:
+        document = json.load(f)
+    return dict(flatten(document['results']))
+
+
+def is_time(name):
+    return name.endswith('.seconds.median') or '.us_per_' in name or name.endswith('.seconds')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="relative change considered significant (default: 0.1)")
+    parser.add_argument('--fail', action='store_true', help="exit with 1 if any time got worse")
+    args = parser.parse_args()
+
+    before = metrics(args.before)
+    after = metrics(args.after)
+    names = [name for name in before if name in after]
+    width = max((len(name) for name in names), default=0)
+    worse_times = 0
+    for name in names:
+        old, new = before[name], after[name]
+        if old == new:
+            change = 0.0
+        elif old == 0:
+            change = float('inf')
+        else:
+            change = (new - old) / abs(old)
+        mark = ''
+        if abs(change) > args.threshold:
+            better = change > 0 if name.rsplit('.', 1)[-1] in HIGHER_IS_BETTER else change < 0
+            mark = 'better' if better else 'worse'
+            if not better and is_time(name):
+                worse_times += 1
+        print('%-*s %14.6g %14.6g %+8.1f%% %s' % (width, name, old, new, change * 100, mark))
+    for name in sorted(set(before) ^ set(after)):
+        print('%-*s only in %s' % (width, name, args.before if name in before else args.after))
+    if args.fail and worse_times:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+SQL queries and time of syncing api objects to Django models.
+
+Syncs n exercises, each linking to one of three courses, with
+get_new_or_updated one object at a time (single) and with
+bulk_get_new_or_updated (bulk), when the rows are:
+ - new: not in the database
+ - fresh: in the database and younger than TTL
+ - stale: older than TTL, but the data hasn't changed
+ - changed: older than TTL and the data has changed
+
+Uses an in-memory SQLite database and requires Django. Run from the
+repository root:
+
+    python benchmarks/django_sync.py --sizes 100 1000 -o django_sync.json
+"""
+import argparse
+import datetime
+
+import common
+
+import django
+from django.conf import settings
+
+settings.configure(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    INSTALLED_APPS=['aplus_client.django'],
+    USE_TZ=True,
+)
+django.setup()
+
+from django.db import connection, models  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from aplus_client.django.models import ApiNamespace, NamespacedApiObject, NestedApiObject  # noqa: E402
+from aplus_client.instrumentation import CountingInstrumentation  # noqa: E402
+from aplus_client.replay import Archive  # noqa: E402
+
+
+class Course(NamespacedApiObject):
+    code = models.CharField(max_length=32)
+    name = models.CharField(max_length=255)
+
+    class Meta(NamespacedApiObject.Meta):
+        app_label = 'aplus_client'
+
+
+class Exercise(NestedApiObject):
+    NAMESPACE_FILTER = 'course__namespace'
+    display_name = models.CharField(max_length=255)
+    max_points = models.IntegerField()
+    course = models.ForeignKey(Course, on_delete=models.CASCADE)
+
+    class Meta(NestedApiObject.Meta):
+        app_label = 'aplus_client'
+
+    @property
+    def namespace(self):
+        return self.course.namespace
+
+
+def archive(n):
+    archive = Archive()
+    for i in range(n):
+        archive.add('GET', '%sexercises/%d/' % (common.API, i), 200, common.exercise(i))
+    for i in range(3):
+        archive.add('GET', '%scourses/%d/' % (common.API, i), 200, common.course(i))
+    return archive
+
+
+def create_tables():
+    if Exercise._meta.db_table not in connection.introspection.table_names():
+        with connection.schema_editor() as editor:
+            for model in (ApiNamespace, Course, Exercise):
+                editor.create_model(model)
+
+
+def reset():
+    Exercise.objects.all().delete()
+    Course.objects.all().delete()
+    ApiNamespace.objects.all().delete()
+    ApiNamespace.objects.clear_cache()
+
+
+def single(api_objs):
+    return [Exercise.objects.get_new_or_updated(api_obj) for api_obj in api_objs]
+
+
+def bulk(api_objs):
+    return Exercise.objects.bulk_get_new_or_updated(api_objs)
+
+
+def prepare(state, api_objs):
+    reset()
+    if state == 'new':
+        return
+    bulk(api_objs)
+    if state == 'fresh':
+        return
+    old = timezone.now() - Exercise.TTL - datetime.timedelta(minutes=1)
+    rows = Exercise.objects.all()
+    if state == 'changed':
+        rows.update(updated=old, display_name='Old name', max_points=0)
+    else:
+        rows.update(updated=old)
+    Course.objects.update(updated=old)
+
+
+def run(sizes=(100, 1000), repeat=3):
+    create_tables()
+    results = {}
+    for n in sizes:
+        responses = archive(n)
+        urls = ['%sexercises/%d/' % (common.API, i) for i in range(n)]
+        for sync in (single, bulk):
+            for state in ('new', 'fresh', 'stale', 'changed'):
+                instrumentation = CountingInstrumentation()
+                queries = []
+
+                def setup():
+                    client = common.replay_client(responses)
+                    api_objs = client.load_many(urls)
+                    prepare(state, api_objs)
+                    instrumentation.reset()
+                    client.instrumentation = instrumentation
+                    return api_objs
+
+                def measured(api_objs):
+                    with CaptureQueriesContext(connection) as captured:
+                        sync(api_objs)
+                    queries.append(len(captured))
+
+                seconds, _ = common.timed(measured, repeat, setup)
+                results['%s.%s.%d' % (sync.__name__, state, n)] = {
+                    'seconds': seconds,
+                    'us_per_object': round(seconds['median'] / n * 1e6, 3),
+                    'queries': queries[-1],
+                    'requests': sum(instrumentation.requests.values()),
+                }
+    return common.report('django_sync', {'sizes': list(sizes), 'repeat': repeat}, results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help="file for the json results (default: stdout)")
+    args = parser.parse_args()
+    common.write(run(args.sizes, args.repeat), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Peak memory and time of loading a large paginated listing.
+
+Serves generated submission pages from memory and measures with tracemalloc:
+ - load: load_data() for the first page
+ - iterate: iterating over all results
+ - access: iterating and reading a nested value from every result
+
+Run from the repository root, e.g. on two commits to compare them:
+
+    python benchmarks/memory.py --count 100000 --page-size 1000 -o memory.json
+
+It uses only PagesClient of common.py, so it also runs on commits older than
+the benchmarks when this directory is copied to them.
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+import common
+from common import PagesClient, page_url, render_pages
+
+
+def measure(func):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return {'seconds': round(elapsed, 4), 'peak_bytes': peak, 'retained_bytes': current}
+
+
+def run(count, page_size):
+    pages = render_pages(count, page_size)
+    first = page_url(0, page_size)
+
+    def load():
+        client = PagesClient(pages)
+        return client, client.load_data(first)
+
+    def iterate():
+        client, items = load()
+        for item in items:
+            pass
+        return client, items
+
+    def access():
+        client, items = load()
+        for item in items:
+            item['exercise']['display_name']
+        return client, items
+
+    return common.report('memory', {'count': count, 'page_size': page_size}, {
+        name: measure(func)
+        for name, func in (('load', load), ('iterate', iterate), ('access', access))
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('-o', '--output', help="file for the json results (default: stdout)")
+    args = parser.parse_args()
+    common.write(run(args.count, args.page_size), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Throughput of iterating over a large paginated listing.
+
+Iterates over all results of a submission listing with the default client,
+with stream_pages and with prefetch_workers:
+ - memory: pages are replayed from memory through the request path of
+   the client, which measures parsing and the api objects
+ - http: pages are served over http by the stub server with the given
+   latency per request, which adds the transport and the round trips
+
+Run from the repository root, e.g. on two commits to compare them:
+
+    python benchmarks/paginated.py --count 20000 --page-size 100 -o paginated.json
+"""
+import argparse
+
+import common
+from aplus_client.cache import InMemoryCache
+from aplus_client.client import AplusClient
+from aplus_client.instrumentation import CountingInstrumentation
+from aplus_client.stubserver import StubServer
+
+
+MODES = {
+    'iterate': {},
+    'stream': {'stream_pages': True},
+    'prefetch': {'prefetch_workers': 4},
+}
+
+
+def iterate(client, url):
+    n = 0
+    for item in client.load_data(url):
+        n += 1
+    return n
+
+
+def measure(make_client, url, count, repeat):
+    instrumentation = CountingInstrumentation()
+
+    def setup():
+        instrumentation.reset()
+        return make_client(instrumentation)
+
+    seconds, n = common.timed(lambda client: iterate(client, url), repeat, setup)
+    assert n == count, "got %d results instead of %d" % (n, count)
+    return {
+        'seconds': seconds,
+        'items_per_second': round(count / seconds['median']),
+        'requests': sum(instrumentation.requests.values()),
+        'pages': sum(instrumentation.pages.values()),
+        'bytes': sum(instrumentation.bytes.values()),
+    }
+
+
+def run(count=20000, page_size=100, latency=0.002, repeat=3, http=True):
+    pages = common.render_pages(count, page_size)
+    archive = common.pages_archive(pages)
+    first = common.page_url(0, page_size)
+    results = {}
+
+    for mode, options in MODES.items():
+        def make_client(instrumentation, options=options):
+            return common.replay_client(archive, instrumentation=instrumentation, **options)
+        results['memory.' + mode] = measure(make_client, first, count, repeat)
+
+    if http:
+        with StubServer(archive, latency=latency) as server:
+            url = first.replace(common.API, server.url + '/api/v2/')
+            for mode, options in MODES.items():
+                def make_client(instrumentation, options=options):
+                    return AplusClient(cache=InMemoryCache(maxsize=len(pages)),
+                                       instrumentation=instrumentation, **options)
+                results['http.' + mode] = measure(make_client, url, count, repeat)
+
+    return common.report('paginated', {
+        'count': count, 'page_size': page_size, 'latency': latency, 'repeat': repeat,
+    }, results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.002, help="seconds per http request")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-http', dest='http', action='store_false')
+    parser.add_argument('-o', '--output', help="file for the json results (default: stdout)")
+    args = parser.parse_args()
+    common.write(run(args.count, args.page_size, args.latency, args.repeat, args.http), args.output)
+
+
+if __name__ == '__main__':
+    main()
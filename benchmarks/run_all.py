@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Runs all benchmarks and writes their results to a single json file.
+
+With --quick, smaller sizes are used, e.g. for a check that the benchmarks
+still run. The Django benchmark is skipped when Django is not installed.
+Run from the repository root on two versions and compare the results:
+
+    python benchmarks/run_all.py -o before.json
+    python benchmarks/run_all.py -o after.json
+    python benchmarks/compare.py before.json after.json
+"""
+import argparse
+import importlib
+import sys
+
+import common
+
+
+BENCHMARKS = {
+    'paginated': ({}, {'count': 2000, 'repeat': 1}),
+    'traversal': ({}, {'count': 2000, 'repeat': 1}),
+    'caches': ({}, {'sizes': (100, 1000), 'repeat': 1}),
+    'memory': ({'count': 20000, 'page_size': 1000}, {'count': 2000, 'page_size': 100}),
+    'django_sync': ({}, {'sizes': (100,), 'repeat': 1}),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('benchmarks', nargs='*',
+                        help="benchmarks to run: %s (default: all)" % (', '.join(BENCHMARKS),))
+    parser.add_argument('--quick', action='store_true', help="use small sizes")
+    parser.add_argument('-o', '--output', help="file for the json results (default: stdout)")
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: %s" % (', '.join(sorted(unknown)),))
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        full, quick = BENCHMARKS[name]
+        try:
+            module = importlib.import_module(name)
+        except ImportError as err:
+            print("Skipping %s: %s" % (name, err), file=sys.stderr)
+            continue
+        print("Running %s" % (name,), file=sys.stderr)
+        report = module.run(**(quick if args.quick else full))
+        results[name] = {'params': report['params'], 'results': report['results']}
+    common.write(common.report('all', {'quick': args.quick}, results), args.output)
+
+
+if __name__ == '__main__':
+    main()
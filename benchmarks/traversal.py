@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Cost of lazy AplusApiDict.get traversal over the results of a listing.
+
+For every submission of the listing:
+ - partial: reads a value included in the partial exercise object
+ - load_all: reads a value missing from it, which loads the full exercise
+ - link: also follows the course link of the exercise
+ - prefetch: the same as link after AplusClient.prefetch()
+
+The linked objects are cached, so the requests measure how well repeated
+traversals are served from the cache. Each case is also run with an
+IdentityMap (the .identity_map results).
+
+Run from the repository root:
+
+    python benchmarks/traversal.py --count 20000 -o traversal.json
+"""
+import argparse
+
+import common
+from aplus_client.client import IdentityMap
+from aplus_client.instrumentation import CountingInstrumentation
+
+
+def partial(items):
+    for item in items:
+        item['exercise']['display_name']
+
+
+def load_all(items):
+    for item in items:
+        item['exercise']['max_points']
+
+
+def link(items):
+    for item in items:
+        item['exercise']['course']['name']
+
+
+def prefetch(items):
+    for item in items._client.prefetch(items, 'exercise.course'):
+        item['exercise']['course']['name']
+
+
+def run(count=20000, page_size=1000, repeat=3):
+    pages = common.render_pages(count, page_size)
+    archive = common.pages_archive(pages)
+    first = common.page_url(0, page_size)
+    results = {}
+    cases = [(func, identity) for identity in (False, True) for func in (partial, load_all, link, prefetch)]
+    for func, identity in cases:
+        instrumentation = CountingInstrumentation()
+
+        def setup():
+            client = common.replay_client(archive, instrumentation=instrumentation,
+                                          identity_map=IdentityMap() if identity else None)
+            items = client.load_data(first)
+            for item in items:
+                pass
+            instrumentation.reset()
+            return items
+
+        seconds, _ = common.timed(func, repeat, setup)
+        results[func.__name__ + ('.identity_map' if identity else '')] = {
+            'seconds': seconds,
+            'us_per_item': round(seconds['median'] / count * 1e6, 3),
+            'requests': sum(instrumentation.requests.values()),
+            'traversals': sum(instrumentation.traversals.values()),
+            'cache': {'%s.%s' % key: value for key, value in instrumentation.cache.items()},
+        }
+    return common.report('traversal', {'count': count, 'page_size': page_size, 'repeat': repeat}, results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help="file for the json results (default: stdout)")
+    args = parser.parse_args()
+    common.write(run(args.count, args.page_size, args.repeat), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Helpers for the tests: a client serving json texts by url
+"""
+import json
+
+from aplus_client.cache import InMemoryCache
+from aplus_client.client import AplusClient
+from aplus_client.debugging import FakeResponse
+
+
+API = 'https://plus.example.org/api/v2/'
+
+
+def page_url(offset, limit):
+    return '%ssubmissions/?limit=%d&offset=%d' % (API, limit, offset)
+
+
+def render_pages(count, page_size):
+    """
+    Returns json texts of a listing of count items by page url
+    """
+    pages = {}
+    for offset in range(0, count, page_size):
+        nxt = offset + page_size
+        pages[page_url(offset, page_size)] = json.dumps({
+            'count': count,
+            'next': page_url(nxt, page_size) if nxt < count else None,
+            'previous': page_url(offset - page_size, page_size) if offset else None,
+            'results': [{'id': i} for i in range(offset, min(nxt, count))],
+        })
+    return pages
+
+
+class TrackedResponse(FakeResponse):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class PagesClient(AplusClient):
+    """
+    Client serving json texts by url, 404 for other urls. Requests and
+    responses are kept in `requests` and `responses`.
+    """
+    def __init__(self, pages, **kwargs):
+        kwargs.setdefault('cache', InMemoryCache())
+        super().__init__(**kwargs)
+        self.pages = pages
+        self.requests = []
+        self.responses = []
+
+    def do_get(self, url, **kwargs):
+        self.requests.append(url)
+        text = self.pages.get(url)
+        if text is None:
+            resp = TrackedResponse(url, 404, '')
+        else:
+            resp = TrackedResponse(url, 200, text)
+        self.responses.append(resp)
+        return resp
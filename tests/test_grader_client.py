@@ -0,0 +1,43 @@
+import json
+import threading
+import unittest
+
+from aplus_client.client import AplusGraderClient
+from aplus_client.debugging import FakeResponse
+
+from .helpers import API
+
+
+SUBMISSION_URL = API + 'submissions/1/grader/?token=abc'
+
+
+class GraderClient(AplusGraderClient):
+    def do_get(self, url, **kwargs):
+        return FakeResponse(url, 200, json.dumps({'id': 1, 'language': 'en'}))
+
+
+class GraderClientTest(unittest.TestCase):
+    def setUp(self):
+        AplusGraderClient.clear_shared()
+
+    def tearDown(self):
+        AplusGraderClient.clear_shared()
+
+    def test_not_shared_by_default(self):
+        client = GraderClient(SUBMISSION_URL)
+        self.assertIsNone(client.shared_cache)
+        self.assertIsNone(client.shared_single_flight)
+
+    def test_busy_prefetch_loads_inline(self):
+        executor = AplusGraderClient.get_shared()[2]
+        release = threading.Event()
+        blockers = [executor.submit(release.wait) for _ in range(AplusGraderClient.prefetch_threads)]
+        try:
+            client = GraderClient(SUBMISSION_URL)
+            future = client.prefetch_grading_data()
+            self.assertEqual(client.grading_data['id'], 1)
+            self.assertTrue(future.cancelled())
+        finally:
+            release.set()
+            for blocker in blockers:
+                blocker.result()
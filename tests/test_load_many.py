@@ -0,0 +1,43 @@
+import asyncio
+import unittest
+
+from aplus_client.aio import AsyncAplusClient, AsyncResponse, AsyncTransport
+from aplus_client.client import AplusApiLoadError
+
+from .helpers import API, PagesClient
+
+
+PAGES = {
+    API + 'courses/1/': '{"id": 1, "code": "CS-1"}',
+    API + 'courses/2/': '{"id": 2, "code": ',
+}
+URLS = [API + 'courses/1/', API + 'courses/2/', API + 'courses/3/']
+
+
+class PagesTransport(AsyncTransport):
+    async def request(self, method, url, headers=None, params=None, data=None, json=None, timeout=None):
+        text = PAGES.get(url)
+        if text is None:
+            return AsyncResponse(url, 404, b'')
+        return AsyncResponse(url, 200, text.encode('utf-8'))
+
+
+class LoadManyTest(unittest.TestCase):
+    def assertResults(self, objects):
+        self.assertNotIsInstance(objects[0], AplusApiLoadError)
+        self.assertIsInstance(objects[1], AplusApiLoadError)
+        self.assertIsNotNone(objects[1].error)
+        self.assertIsInstance(objects[2], AplusApiLoadError)
+        self.assertIsNone(objects[2].error)
+
+    def test_malformed_body(self):
+        client = PagesClient(PAGES)
+        objects = client.load_many(URLS)
+        self.assertResults(objects)
+        self.assertEqual(objects[0].code, 'CS-1')
+
+    def test_malformed_body_async(self):
+        async def load():
+            async with AsyncAplusClient(transport=PagesTransport()) as client:
+                return await client.load_many(URLS)
+        self.assertResults(asyncio.run(load()))
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+from time import time
+
+from aplus_client.debugging import FakeResponse
+from aplus_client.outbox import GradeOutbox
+
+from .helpers import API
+
+
+class RecordingTransport:
+    def __init__(self, on_request=None):
+        self.urls = []
+        self.on_request = on_request
+
+    def request(self, method, url, **kwargs):
+        self.urls.append(url)
+        if self.on_request is not None:
+            self.on_request()
+        return FakeResponse(url, 200, '')
+
+
+class GradeOutboxTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'outbox.sqlite3')
+
+    def outbox(self, transport, **kwargs):
+        return GradeOutbox(self.path, transport=transport, autostart=False, **kwargs)
+
+    def test_delivers_due_results(self):
+        transport = RecordingTransport()
+        outbox = self.outbox(transport)
+        for i in range(3):
+            outbox.enqueue('%ssubmissions/%d/grader/' % (API, i), json={'points': i})
+        self.assertEqual(outbox.deliver_due(), 3)
+        self.assertEqual(len(transport.urls), 3)
+        self.assertEqual(outbox.metrics()['depth'], 0)
+
+    def test_expired_lease_during_batch(self):
+        other_transport = RecordingTransport()
+        other = self.outbox(other_transport, lease=60)
+        claimed = []
+
+        def take_over():
+            # the lease of the batch expires while the first result is sent
+            if not claimed:
+                claimed.extend(other._claim(time() + 61))
+
+        transport = RecordingTransport(take_over)
+        outbox = self.outbox(transport, lease=60)
+        urls = ['%ssubmissions/%d/grader/' % (API, i) for i in range(3)]
+        for i, url in enumerate(urls):
+            outbox.enqueue(url, json={'points': i})
+
+        self.assertEqual(outbox.deliver_due(), 1)
+        self.assertEqual(transport.urls, urls[:1])
+        # the other process sends the rest, each result is sent once
+        self.assertEqual(sum(other._deliver(*row) for row in claimed), 2)
+        self.assertEqual(transport.urls + other_transport.urls, urls)
+        self.assertEqual(outbox.metrics()['depth'], 0)
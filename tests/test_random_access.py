@@ -0,0 +1,38 @@
+import unittest
+
+from .helpers import PagesClient, page_url, render_pages
+
+
+class RandomAccessTest(unittest.TestCase):
+    def test_loads_only_needed_pages(self):
+        client = PagesClient(render_pages(45, 10))
+        listing = client.load_data(page_url(0, 10))
+        self.assertEqual(listing[33]['id'], 33)
+        self.assertEqual([item['id'] for item in listing[18:22]], [18, 19, 20, 21])
+        self.assertEqual(client.requests, [page_url(offset, 10) for offset in (0, 30, 10, 20)])
+
+    def test_missing_page(self):
+        pages = render_pages(45, 10)
+        del pages[page_url(20, 10)]
+        client = PagesClient(pages)
+        listing = client.load_data(page_url(0, 10))
+        self.assertEqual(listing[33]['id'], 33)
+        with self.assertRaisesRegex(IndexError, 'page %s ' % (page_url(20, 10).replace('?', r'\?'),)):
+            listing[25]
+
+    def test_missing_page_prefetched(self):
+        pages = render_pages(45, 10)
+        del pages[page_url(20, 10)]
+        client = PagesClient(pages, prefetch_workers=2)
+        listing = client.load_data(page_url(0, 10))
+        with self.assertRaisesRegex(IndexError, "couldn't be loaded"):
+            listing[5:40]
+        self.assertEqual(listing[35]['id'], 35)
+
+    def test_short_page(self):
+        pages = render_pages(45, 10)
+        pages[page_url(30, 10)] = pages[page_url(40, 10)]
+        client = PagesClient(pages)
+        listing = client.load_data(page_url(0, 10))
+        with self.assertRaisesRegex(IndexError, 'has no result 8'):
+            listing[38]
@@ -0,0 +1,61 @@
+import unittest
+
+from aplus_client.instrumentation import CountingInstrumentation
+
+from .helpers import PagesClient, page_url, render_pages
+
+
+class StreamPagesTest(unittest.TestCase):
+    def test_iterates_all_pages(self):
+        client = PagesClient(render_pages(25, 10), stream_pages=True)
+        ids = [item['id'] for item in client.load_data(page_url(0, 10))]
+        self.assertEqual(ids, list(range(25)))
+        self.assertTrue(all(resp.closed for resp in client.responses[1:]))
+
+    def test_pages_are_cached(self):
+        client = PagesClient(render_pages(25, 10), stream_pages=True)
+        list(client.load_data(page_url(0, 10)))
+        requests = len(client.requests)
+        ids = [item['id'] for item in client.load_data(page_url(0, 10))]
+        self.assertEqual(ids, list(range(25)))
+        self.assertEqual(len(client.requests), requests)
+
+    def test_abandoned_iterator_closes_response(self):
+        client = PagesClient(render_pages(25, 10), stream_pages=True)
+        listing = client.load_data(page_url(0, 10))
+        items = iter(listing)
+        for _ in range(12):
+            next(items)
+        items.close()
+        resp = client.responses[-1]
+        self.assertEqual(resp.url, page_url(10, 10))
+        self.assertTrue(resp.closed)
+        self.assertEqual(client.single_flight._futures, {})
+        # the partial page is dropped and loaded again
+        ids = [item['id'] for item in listing]
+        self.assertEqual(ids, list(range(25)))
+
+    def test_malformed_page_ends_iteration(self):
+        pages = render_pages(25, 10)
+        pages[page_url(10, 10)] = pages[page_url(10, 10)][:-20]
+        client = PagesClient(pages, stream_pages=True)
+        with self.assertLogs('aplus_client.client', 'WARNING'):
+            ids = [item['id'] for item in client.load_data(page_url(0, 10))]
+        # results parsed before the error were already yielded
+        self.assertEqual(ids, list(range(len(ids))))
+        self.assertLess(len(ids), 20)
+        self.assertTrue(client.responses[-1].closed)
+        self.assertEqual(client.single_flight._futures, {})
+
+    def test_reports_json_parsed(self):
+        parsed = []
+
+        class Instrumentation(CountingInstrumentation):
+            def json_parsed(self, endpoint, duration):
+                parsed.append(endpoint)
+                super().json_parsed(endpoint, duration)
+
+        client = PagesClient(render_pages(25, 10), stream_pages=True, instrumentation=Instrumentation())
+        list(client.load_data(page_url(0, 10)))
+        # the first page is loaded as usual and the others are streamed
+        self.assertEqual(len(parsed), 3)